@@ -1,56 +1,38 @@
+import startup
+
+import json
+import sys
+
 import numpy as np
-import csv
-import pandas as pd
 import plotly.io as pio
 pio.templates.default = "seaborn"
-# Standard plotly imports
-from chart_studio.plotly import plot, iplot
 import plotly.graph_objs as go
-from plotly.offline import iplot, init_notebook_mode
-# Using plotly + cufflinks in offline mode
-import cufflinks
-cufflinks.go_offline(connected=True)
 import dash
 import dash_core_components as dcc
-import dash_daq as daq
 import dash_html_components as html
-from dash.dependencies import Input, Output, State
+from dash.dependencies import ClientsideFunction, Input, Output, State
 import dash_bootstrap_components as dbc
 
-# loading drug use dataset
-drug_use = pd.read_csv('data/drug-use-by-age.csv')
-
-# '-' spotted, replaced with 0 as linked to use value which equals zero in this instance
-drug_use.replace('-','0',inplace=True)
-
-# Range in age replaced with means of range values to enable use in calculation
-# as object type not accepted
-drug_use.age.replace({'22-23':'22.5','24-25':'24.5','26-29':'27.5','30-34':'32',
-                      '35-49':'42','50-64':'57','65+':'65'},inplace=True)
-
-
-# set variable types
-for col in drug_use.select_dtypes(include=['object']).columns:
-    drug_use[col] = drug_use[col].astype('float')
-
-drug_use.set_index('age',inplace=True) 
+import settings
+import datastore
+from dispatch import callback_ids, wrap_callbacks
+from encoding import encode_series
+from figcache import FigureCache
+from layoutcache import LayoutResponses
+from metrics import CallbackMetrics
+import lite
+import serialize
+from prerender import PrerenderedResponses
+from singleflight import SingleFlight
 
+startup.mark('imports')
 
-## Creating a DF with the use, setting 'age' as index and removing -use in column names
+prerendered = PrerenderedResponses(settings.PRERENDERED_DIR) if settings.PRERENDERED_DIR else None
 
-usage = drug_use[(drug_use.columns.values[drug_use.columns.str.contains('use')])]
-usage.columns = usage.columns.str.replace('-use','')
+## how figure updates reach the browser, see settings.FIGURE_UPDATES;
+## pre-rendered responses can only be served in the mode they were rendered in
+figure_updates = prerendered.meta['figure_updates'] if prerendered else settings.FIGURE_UPDATES
 
-usage_transformed = usage.apply(lambda x: x/100)
-
-## Creating a DF with the frequency, removing -frequency in column names
-
-frequency = drug_use[(drug_use.columns.values[drug_use.columns.str.contains('freq')])]
-
-frequency.columns = frequency.columns.str.replace('-frequency','')
-
-for col in frequency.columns:
-    frequency[col] = frequency[col].astype('int')
 
 
 layout_us_bar={
@@ -90,21 +72,18 @@ layout_us_bar={
             'showarrow':False}]
  }
 
-##read them into pandas
-
-big_df=pd.read_csv('data/global_df.csv')
-
-## slider marks design
+## slider marks design: the first and last years labelled, the years between unlabelled
 
-# slider marks design
+visible_style = {'font-size':'medium','color':'DimGrey','font-weight':'bold'}
+visible2_style = {'color':'DimGrey'}
 
-visible = {1990:{'label':'1990','style':{'font-size':'medium','color':'DimGrey','font-weight':'bold'}},2017:{'label':'2017','style':{'font-size':'medium','color':'DimGrey','font-weight':'bold'}}}
-visible2 = {1990:{'label':'1990','style':{'color':'DimGrey'}},2017:{'label':'2017','style':{'color':'DimGrey'}}}
-                                                                                                                                    
-invisible ={str(i):'' for i in big_df['year'].unique()[1:-1]}
+def year_marks(years, style):
+    marks = {y:{'label':str(y),'style':style} for y in (years[0], years[-1])}
+    marks.update({str(i):'' for i in years[1:-1]})
+    return marks
 
-visible.update(invisible)
-visible2.update(invisible)                                        
+## template for the death rates map, shared by every request so never modified in place;
+## death_rates_layout() builds the per-request copy
 
 layout={
     'title':'<b>Death rates from drug use disorders in 1990</b> <br><sub>measured per 100,000 individuals</sub>',
@@ -132,20 +111,15 @@ layout={
             IHME, Global Burden of Disease </a>',
         'showarrow':False}]}
 
-## mental health df
-mental_health = pd.read_csv('data/mental-health-as-risk-for-drug-dependency.csv')
-
-trace_mh = [go.Bar(
-                y=mental_health['Entity'],
-                x=mental_health.iloc[:,3],
-                name='Odds ratio',
-                orientation='h',
-                marker=dict(color=[np.log(x + 0.1) for x in mental_health.iloc[:,3]],
-                                colorscale='PuBu',
-                                line=dict(color='DarkBlue')
-                                ),
-                hovertemplate="%{x}"
-            )]
+def death_rates_geo(scope):
+    return dict(showframe=False, showcoastlines=True,
+                lataxis_range=[-60, 90], projection_type='equirectangular',
+                scope=scope)
+
+
+def death_rates_layout(title, scope):
+    return dict(layout, title=title, geo=death_rates_geo(scope))
+
 
 layout_mh={
 	'xaxis':{
@@ -189,15 +163,20 @@ layout_mh={
 }
 	
 
-fig_mh = go.Figure(data=trace_mh,layout=layout_mh)
-
-#. http://ghdx.healthdata.org/gbd-results-tool?params=gbd-api-2017-permalink/3c5c2b8846e4b1ecae4a9eb461e9a193
-
-disorder_age_sex = pd.read_csv('data/my_data.csv')
-disorder_age_sex = disorder_age_sex[['location','sex','age','year','val']]
-disorder_age_sex.replace('Global','World',inplace=True)
-disorder_age_sex = disorder_age_sex.replace('5-14 years','05-14').replace('70+ years','70+').sort_values(by='age')
+def mental_health_figure(mental_health):
+    trace_mh = [go.Bar(
+                    y=mental_health['Entity'],
+                    x=mental_health.iloc[:,3],
+                    name='Odds ratio',
+                    orientation='h',
+                    marker=dict(color=np.log(mental_health.iloc[:,3].to_numpy() + 0.1),
+                                    colorscale='PuBu',
+                                    line=dict(color='DarkBlue')
+                                    ),
+                    hovertemplate="%{x}"
+                )]
 
+    return go.Figure(data=trace_mh,layout=layout_mh)
 
 layout_prev={
     'xaxis' : {
@@ -243,7 +222,156 @@ layout_prev={
 
 
 
-regions_dict = [{'label':i,'value':i} for i in disorder_age_sex.location.unique()]
+## drug dropdown value -> rate column, and rate column -> wording used in the map title
+
+drug_columns = {'ALL': 'all_rate',
+                'C': 'cocaine_rate',
+                'AMP': 'amphetamine_rate',
+                'OP': 'opioid_rate'}
+
+drug_titles = {'all_rate': 'drug use disorders',
+               'cocaine_rate': 'cocaine overdoses',
+               'amphetamine_rate': 'amphetamine overdoses',
+               'opioid_rate': 'opioid overdoses'}
+
+
+death_rates_title_format = '<b>Death rates from {drug} in {year}, {scope}</b> <br><sub>measured per 100,000 individuals</sub>'
+
+prevalence_title_format = "Share of population within each age category suffering from drug use disorders in {year}, {region}"
+
+
+def death_rates_title(selected_drug, selected_year, selected_scope, options):
+    lb = [options[i]['label'] for i in range(len(options))
+          if options[i]['value'] == selected_scope]
+
+    return death_rates_title_format.format(drug=drug_titles.get(drug_columns.get(selected_drug)),
+                                           year=selected_year, scope=lb[0])
+
+
+def prevalence_title(selected_region, selected_year):
+    return prevalence_title_format.format(year=selected_year, region=selected_region)
+
+
+## static trace properties, shared by the full figures and the patch-mode base figures
+
+choropleth_style = dict(
+    zmin=0,
+    zmid=1,
+    hoverinfo="z+text",
+    colorscale=["#f7fbff", "#c6dbef", "#85bcdb", "#6baed6",
+                "#57a0ce", "#4292c6", "#3082be", "#2171b5",
+                "#1361a9", "#08519c", "#0b4083", "#08306b"],
+    marker={'line': {'color': 'darkgray', 'width': 0.5}},
+    colorbar={'x': 1, 'thickness': 15, 'nticks': 5, 'len': 0.95})
+
+prevalence_bar_styles = [
+    dict(name='Female',
+         orientation='h',
+         marker=dict(color='rgb(146,197,222)',
+                     line=dict(color='Darkblue'))),
+    dict(name='Male',
+         orientation='h',
+         marker=dict(color='rgb(8,64,129)',
+                     line=dict(color='DarkBlue')))]
+
+drug_use_bar_style = dict(
+    orientation='h',
+    marker=dict(colorscale='PuBu',
+                line=dict(color='DarkBlue',width=0.8)),
+    hovertemplate="%{x:.1%} | %{y}")
+
+
+## the styles above as plotly.js JSON. plotly validates them once here and the callbacks fill
+## copies in with their arrays, instead of validating every property and array on every call.
+## The layouts are sent as written, so they are only checked here.
+
+choropleth_template = go.Choropleth(visible=True, **choropleth_style).to_plotly_json()
+prevalence_bar_templates = [go.Bar(**style).to_plotly_json() for style in prevalence_bar_styles]
+# lite mode rounds the bars to a tenth of the .3% their hover shows
+prevalence_step = 1e-6
+drug_use_bar_template = go.Bar(**drug_use_bar_style).to_plotly_json()
+
+for checked in (layout, layout_mh, layout_prev, layout_us_bar):
+    go.Layout(checked)
+
+
+## patch and preload modes: the map and the prevalence bars receive their static parts once, with
+## the page. In patch mode their callbacks only send the arrays and titles that change
+## (assets/figure_patch.js); in preload mode they send every year at once and the year sliders
+## pick from those in the browser (assets/figure_series.js)
+
+def death_rates_base(death_rates_index):
+    trace = dict(choropleth_template)
+    if death_rates_index.shared_locations:
+        rows = death_rates_index.year(death_rates_index.years[0])
+        trace.update(locations=rows['code'], text=rows['country'])
+    return {'data': [trace], 'layout': layout}
+
+
+def prevalence_base(prevalence_index):
+    traces = [dict(template) for template in prevalence_bar_templates]
+    if prevalence_index.shared_ages:
+        for trace in traces:
+            trace['y'] = prevalence_index.ages
+    return {'data': traces, 'layout': layout_prev}
+
+
+## the data, see datastore.py. A snapshot holds the indexes the callbacks read (per-year arrays
+## and global maxima, so the map callback never scans global_df; female/male age arrays per
+## (location, year), so the prevalence callback never scans my_data) and what the layout shows.
+## The indexes are memory-mapped from data/columnar when preprocess.py has been run, so gunicorn
+## workers share them instead of each holding a copy of the frames.
+
+def build_snapshot(previous=None):
+    snapshot = datastore.load_snapshot(previous)
+    if previous is not None and snapshot.mental_health is previous.mental_health:
+        snapshot.fig_mh = previous.fig_mh
+    else:
+        snapshot.fig_mh = mental_health_figure(snapshot.mental_health)
+    if figure_updates == 'full':
+        snapshot.figure_bases = None
+    else:
+        snapshot.figure_bases = {'death-rates-base': death_rates_base(snapshot.death_rates_index),
+                                 'prevalence-base': prevalence_base(snapshot.prevalence_index)}
+    return snapshot
+
+
+def prerendered_snapshot(previous=None):
+    ## booting from pre-rendered responses: no CSVs are read, and the data never changes
+    meta = prerendered.meta
+    return datastore.Snapshot(prerendered.version,
+                              years=meta['years'],
+                              prevalence_years=meta['prevalence_years'],
+                              regions_dict=meta['regions_dict'],
+                              region_values={r['value'] for r in meta['regions_dict']},
+                              age_dict={int(k):v for k,v in meta['age_dict'].items()},
+                              fig_mh=meta['fig_mh'],
+                              figure_bases=meta['figure_bases'])
+
+
+def invalidate_responses(changed):
+    ## drop the cached responses a data reload made stale: all those of a callback reading a
+    ## changed dataset or, for callbacks taking a year, only those of the years that changed
+    stale_years = {}
+    for name, callback_id in callback_ids(app).items():
+        dataset, year_position = callback_datasets.get(name, (None, None))
+        if dataset in changed:
+            stale_years[callback_id] = (year_position, changed[dataset])
+
+    def stale(key):
+        callback_id, args = key.split('|', 1)
+        if callback_id not in stale_years:
+            return False
+        year_position, years = stale_years[callback_id]
+        return year_position is None or years is None or json.loads(args)[year_position] in years
+
+    figure_cache.discard(stale)
+
+
+store = datastore.DataStore(build_snapshot if prerendered is None else prerendered_snapshot,
+                            on_swap=invalidate_responses)
+
+startup.mark('data')
 
 
 # Navbar
@@ -267,7 +395,16 @@ NAVBAR = dbc.Navbar(
                 no_gutters=True,
             ),
             href="https://github.com/emilieallen",
-        )
+        ),
+        # lite data mode (see lite.py), remembered by the browser
+        dbc.Checklist(id='data-mode',
+                      options=[{'label': 'Lite data', 'value': lite.LITE}],
+                      value=[],
+                      switch=True,
+                      persistence=True,
+                      persistence_type='local',
+                      className='ml-auto',
+                      labelStyle={'color': '#F0FFFF'})
     ],
     color="#778899",
     sticky="top"
@@ -293,187 +430,196 @@ _For more information go to [Our World in Data](https://ourworldindata.org/illic
 
 
 
+def figure_stores(snapshot, name):
+    if snapshot.figure_bases is None:
+        return []
+    return [dcc.Store(id=name + '-base', data=snapshot.figure_bases[name + '-base']),
+            dcc.Store(id=name + '-' + figure_updates)]
+
+
 # In[19]:
 
 
-DEATH_RATES_PLOT = [
-    dbc.CardHeader(html.H5("Deaths from drug use disorders")),
-    dbc.CardBody(
-        [
-            dcc.Loading(
-                id="loading-death_rates",
-                children=[
-                    dbc.Alert(
-                        "Something's gone wrong! Give us a moment, but try\
+scope_options=[
+    {'label': u'World', 'value': 'world'},
+    {'label': 'Europe', 'value': 'europe'},
+    {'label': 'USA', 'value': 'usa'},
+    {'label': 'Asia', 'value': 'asia'},
+    {'label': 'Africa', 'value': 'africa'},
+    {'label': 'North America', 'value': 'north america'},
+    {'label': 'South America', 'value': 'south america'}
+    ]
+
+drug_options=[
+    {'label': u'Drug Disorder', 'value': 'ALL'},
+    {'label': 'Cocaine', 'value': 'C'},
+    {'label': 'Amphetamine', 'value': 'AMP'},
+    {'label': 'Opioid', 'value': 'OP'}
+    ]
+
+def death_rates_plot(snapshot):
+    return [
+        dbc.CardHeader(html.H5("Deaths from drug use disorders")),
+        dbc.CardBody(
+            [
+                dcc.Loading(
+                    id="loading-death_rates",
+                    children=[
+                        dbc.Alert(
+                            "Something's gone wrong! Give us a moment, but try\
                         loading this page again if problem persists.",
-                        id="no-data-alert-death_rates",
-                        color="warning",
-                        style={"display": "none"},
-                    ),
-                    dbc.Row(
-                        [
-                            dbc.Col(html.P("Select the region and drug type:"),
-                                    md=12),
-                            dbc.Col(
-                                [
-                                    dcc.Dropdown(
-                                        id="region-dropdown",
-                                        options=[
-                                            {'label': u'World',
-                                                'value': 'world'},
-                                            {'label': 'Europe',
-                                                'value': 'europe'},
-                                            {'label': 'USA', 'value': 'usa'},
-                                            {'label': 'Asia', 'value': 'asia'},
-                                            {'label': 'Africa',
-                                                'value': 'africa'},
-                                            {'label': 'North America',
-                                                'value': 'north america'},
-                                            {'label': 'South America',
-                                                'value': 'south america'}
-                                            ],
-                                        value='world',
-                                        clearable=False
-                                    )
-                                ],
-                                md=6,
-                            ),
-                            dbc.Col(
-                                [
-                                    dcc.Dropdown(
-                                        id="drug_type-dropdown",
-                                        options=[
-                                            {'label': u'Drug Disorder',
-                                             'value': 'ALL'},
-                                            {'label': 'Cocaine', 'value': 'C'},
-                                            {'label': 'Amphetamine',
-                                             'value': 'AMP'},
-                                            {'label': 'Opioid', 'value': 'OP'}
-                                            ],
-                                        value='ALL',
-                                        clearable=False
-                                    )
-                                ],
-                                md=6,
-                            ),
-                        ]
-                    ),
-                    html.Br(),
-                    dcc.Graph(id="death-rates-graph"),
-                    html.Br(),
-                    dcc.Slider(
-                        id="death-rates-year-slider",
-                        min=big_df['year'].unique()[0],
-                        max=big_df['year'].unique()[-1],
-                        value=big_df['year'].unique()[0],
-                        marks=visible,
-                        included=False
+                            id="no-data-alert-death_rates",
+                            color="warning",
+                            style={"display": "none"},
                         ),
-                ],
-                type="default",
-            )
-        ],
-        style={"marginTop": 0, "marginBottom": 0},
-    ),
-]
+                        dbc.Row(
+                            [
+                                dbc.Col(html.P("Select the region and drug type:"),
+                                        md=12),
+                                dbc.Col(
+                                    [
+                                        dcc.Dropdown(
+                                            id="region-dropdown",
+                                            options=scope_options,
+                                            value='world',
+                                            clearable=False
+                                        )
+                                    ],
+                                    md=6,
+                                ),
+                                dbc.Col(
+                                    [
+                                        dcc.Dropdown(
+                                            id="drug_type-dropdown",
+                                            options=drug_options,
+                                            value='ALL',
+                                            clearable=False
+                                        )
+                                    ],
+                                    md=6,
+                                ),
+                            ]
+                        ),
+                        html.Br(),
+                        dcc.Graph(id="death-rates-graph"),
+                        *figure_stores(snapshot, 'death-rates'),
+                        html.Br(),
+                        dcc.Slider(
+                            id="death-rates-year-slider",
+                            min=snapshot.years[0],
+                            max=snapshot.years[-1],
+                            value=snapshot.years[0],
+                            marks=year_marks(snapshot.years, visible_style),
+                            included=False
+                            ),
+                    ],
+                    type="default",
+                )
+            ],
+            style={"marginTop": 0, "marginBottom": 0},
+        ),
+    ]
 
 
 # In[20]:
 
 
-MENTAL_HEALTH_PLOT = [
-    dbc.CardHeader(html.H5("Risk factor: mental health & substance abuse")),
-    dbc.CardBody(
-        [
-            html.P(
-                "The ADHD value of 5.2 indicates that individuals with ADHD are 5.2 times as likely to\
+def mental_health_plot(snapshot):
+    return [
+        dbc.CardHeader(html.H5("Risk factor: mental health & substance abuse")),
+        dbc.CardBody(
+            [
+                html.P(
+                    "The ADHD value of 5.2 indicates that individuals with ADHD are 5.2 times as likely to\
                  develop drug dependency relative to those without.",
-                style={"fontSize": 13},
-                className="mb-0",
-            ),
+                    style={"fontSize": 13},
+                    className="mb-0",
+                ),
 
-            html.Br(),
+                html.Br(),
 
-            dcc.Graph(id="mental-health", figure=fig_mh)
-        ],
-        style={"marginTop": 10, "marginBottom": 0},
-    )
-]
+                dcc.Graph(id="mental-health", figure=snapshot.fig_mh)
+            ],
+            style={"marginTop": 10, "marginBottom": 0},
+        )
+    ]
 
 
 # In[21]:
 
 
-LEFT_COLUMN = dbc.Jumbotron(
-    [
-        html.H6(children="Data Selection",style={'fontSize':15}),
-        html.Hr(className="my-2"),
-        html.Label("Select a year", style={'fontSize':'small'}),
-        dcc.Slider(
-            id="prevalence-year-slider",
-            min=big_df['year'].unique()[0],
-            max=big_df['year'].unique()[-1],
-            value=big_df['year'].unique()[0],
-            marks=visible2,
-            included=False
-            ),
-        html.Label("Select a region", style={"marginTop": 10,'fontSize':'small'}),
-        dcc.Dropdown(
-            id="prevalence-region",
-            options=regions_dict,
-            clearable=False,
-            value='World',
-            style={'fontSize':'14px'}
-        )
-    ], style={'padding':'20px 10px'}
-)
+def left_column(snapshot):
+    return dbc.Jumbotron(
+        [
+            html.H6(children="Data Selection",style={'fontSize':15}),
+            html.Hr(className="my-2"),
+            html.Label("Select a year", style={'fontSize':'small'}),
+            dcc.Slider(
+                id="prevalence-year-slider",
+                min=snapshot.prevalence_years[0],
+                max=snapshot.prevalence_years[-1],
+                value=snapshot.prevalence_years[0],
+                marks=year_marks(snapshot.prevalence_years, visible2_style),
+                included=False
+                ),
+            html.Label("Select a region", style={"marginTop": 10,'fontSize':'small'}),
+            dcc.Dropdown(
+                id="prevalence-region",
+                options=snapshot.regions_dict,
+                clearable=False,
+                value='World',
+                style={'fontSize':'14px'}
+            )
+        ], style={'padding':'20px 10px'}
+    )
 
 
 # In[22]:
 
 
-PREVALENCE_PLOT = [
-    dbc.CardHeader(html.H5("Prevalence of drug use disorders")),
-    dbc.CardBody(
-        [
-            html.H6(children=["Share of 18 year old who admitted using the following drugs in the past year"],
-                    className="card-title",style={'text-align':'center'},
-                    id='prevalence-title'),
-            dbc.Row([
-                dbc.Col(LEFT_COLUMN,md=3),
-                dbc.Col(dcc.Graph(id="prevalence-graph"),md=9)
-            ])
-        ]
-    )
+def prevalence_plot(snapshot):
+    return [
+        dbc.CardHeader(html.H5("Prevalence of drug use disorders")),
+        dbc.CardBody(
+            [
+                html.H6(children=["Share of 18 year old who admitted using the following drugs in the past year"],
+                        className="card-title",style={'text-align':'center'},
+                        id='prevalence-title'),
+                dbc.Row([
+                    dbc.Col(left_column(snapshot),md=3),
+                    dbc.Col(dcc.Graph(id="prevalence-graph"),md=9)
+                ]),
+                *figure_stores(snapshot, 'prevalence')
+            ]
+        )
 
-]
+    ]
 
 
 # In[23]:
 
 
-age_dict={x:str(round(i)) for x,i in enumerate(drug_use.index)}
-
-US_DRUG_USE = [
-    dbc.CardHeader(html.H5("How Americans get high")),
-    dbc.CardBody([
-        html.H6(className="card-title",style={'text-align':'center'},id='drug-use-title'),
-        html.P(className="card-subtitle",style={'text-align':'center',"fontSize": 13,'marginBottom':10},
-                    id='drug-use-subtitle'),
-        dbc.Row([
-            dbc.Col([html.P("Select age:"),
-                     dcc.Slider(id="age-slider",
-                               min=0,
-                               max=16,
-                               value=6,
-                               marks=age_dict,
-                               vertical=True,
-                               included=False)],md=3,style={'display': 'flex','align_items':'center',
-                                                               'flex-direction':'col','padding':'15px',
-                                                              'justify-content':'space-around'}),
-            dbc.Col(dcc.Graph(id="drug_use"),style={'marginLeft':10})])
-    ])
-]
+def us_drug_use(snapshot):
+    return [
+        dbc.CardHeader(html.H5("How Americans get high")),
+        dbc.CardBody([
+            html.H6(className="card-title",style={'text-align':'center'},id='drug-use-title'),
+            html.P(className="card-subtitle",style={'text-align':'center',"fontSize": 13,'marginBottom':10},
+                        id='drug-use-subtitle'),
+            dbc.Row([
+                dbc.Col([html.P("Select age:"),
+                         dcc.Slider(id="age-slider",
+                                   min=0,
+                                   max=len(snapshot.age_dict) - 1,
+                                   value=6,
+                                   marks=snapshot.age_dict,
+                                   vertical=True,
+                                   included=False)],md=3,style={'display': 'flex','align_items':'center',
+                                                                   'flex-direction':'col','padding':'15px',
+                                                                  'justify-content':'space-around'}),
+                dbc.Col(dcc.Graph(id="drug_use"),style={'marginLeft':10})])
+        ])
+    ]
 
 
 # In[24]:
@@ -481,107 +627,226 @@ US_DRUG_USE = [
 
 # body
 
-BODY = dbc.Container(
-    [
-        dbc.Row([dbc.Col(dbc.Card(MARKDOWN))], style={"marginTop": 30}),
-        dbc.Row([dbc.Col(dbc.Card(DEATH_RATES_PLOT))], style={"marginTop": 30}),
-        dbc.Row([dbc.Col(dbc.Card(MENTAL_HEALTH_PLOT))], style={"marginTop": 30}),
-        dbc.Row([dbc.Col(dbc.Card(PREVALENCE_PLOT))], style={"marginTop": 30}),
-        dbc.Row([dbc.Col(dbc.Card(US_DRUG_USE))], style={"marginTop": 30})
+def body(snapshot):
+    return dbc.Container(
+        [
+            dbc.Row([dbc.Col(dbc.Card(MARKDOWN))], style={"marginTop": 30}),
+            dbc.Row([dbc.Col(dbc.Card(death_rates_plot(snapshot)))], style={"marginTop": 30}),
+            dbc.Row([dbc.Col(dbc.Card(mental_health_plot(snapshot)))], style={"marginTop": 30}),
+            dbc.Row([dbc.Col(dbc.Card(prevalence_plot(snapshot)))], style={"marginTop": 30}),
+            dbc.Row([dbc.Col(dbc.Card(us_drug_use(snapshot)))], style={"marginTop": 30})
 
-    ],
-    className="mt-12",
-)
+        ],
+        className="mt-12",
+    )
 
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
 
 #app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
-app = dash.Dash(__name__,external_stylesheets=[dbc.themes.BOOTSTRAP,external_stylesheets])
+app = dash.Dash(__name__,external_stylesheets=[dbc.themes.BOOTSTRAP,external_stylesheets],compress=True)
 server = app.server  # for Heroku deployment
 
-app.layout = html.Div(children=[NAVBAR,BODY])
+def page_layout(snapshot):
+    return html.Div(children=[NAVBAR,body(snapshot)])
 
-@app.callback(
-    dash.dependencies.Output('death-rates-graph', 'figure'),
-    [dash.dependencies.Input('drug_type-dropdown', 'value'),
-     dash.dependencies.Input('death-rates-year-slider', 'value'),
-     dash.dependencies.Input('region-dropdown', 'value'),
-     dash.dependencies.Input('region-dropdown', 'options'),])
-def update_death_rates_figure(selected_drug, selected_year, selected_scope, options):
-    title = {'all_rate': 'drug use disorders',
-             'cocaine_rate': 'cocaine overdoses',
-             'amphetamine_rate': 'amphetamine overdoses',
-             'opioid_rate': 'opioid overdoses'}
-    lexique = {'ALL': 'all_rate',
-               'C': 'cocaine_rate',
-               'AMP': 'amphetamine_rate',
-               'OP': 'opioid_rate'}
-    col = lexique.get(selected_drug)
-    tl = title.get(col)
-
-    trace = [go.Choropleth(
-                visible=True,
-                locations=big_df.code[big_df.year == selected_year],
-                z=big_df[col][big_df.year == selected_year],
-                zmin=0,
-                zmid=1,
-                zmax=big_df[col].max(),
-                text=big_df.country[big_df.year == selected_year],
-                name=str(selected_year),
-                hoverinfo="z+text",
-                colorscale=["#f7fbff", "#c6dbef", "#85bcdb", "#6baed6",
-                            "#57a0ce", "#4292c6", "#3082be", "#2171b5",
-                            "#1361a9", "#08519c", "#0b4083", "#08306b"],
-                marker_line_color='darkgray',
-                marker_line_width=0.5,
-                colorbar={'x': 1, 'thickness': 15, 'nticks': 5, 'len': 0.95}
-            )]
+def serve_layout():
+    ## built from the current data, so a reload also moves the sliders
+    return page_layout(store.snapshot)
 
-    lb = [options[i]['label'] for i in range(len(options))
-          if options[i]['value'] == selected_scope]
+app.layout = serve_layout
 
-    layout['geo'] = dict(showframe=False, showcoastlines=True,
-                         lataxis_range=[-60, 90], projection_type='equirectangular',
-                         scope=selected_scope)
+## _dash-layout is serialized once per data version and sent with an ETag and Cache-Control
 
-    layout['title'] = '<b>Death rates from {} in {}, {}</b> <br><sub>measured per 100,000 individuals</sub>'.format(tl, selected_year, lb[0])
+layout_responses = LayoutResponses(page_layout, store)
+layout_responses.replace_route(app)
 
-    return {'data': trace, 'layout': layout}
+startup.mark('layout')
 
-@app.callback(
+def callback_in_mode(mode, output, inputs, state=()):
+    ## @app.callback that only registers the function when figures are updated in this mode
+    if figure_updates == mode:
+        return app.callback(output, inputs, state)
+    return lambda func: func
+
+
+death_rates_inputs = [dash.dependencies.Input('drug_type-dropdown', 'value'),
+                      dash.dependencies.Input('death-rates-year-slider', 'value'),
+                      dash.dependencies.Input('region-dropdown', 'value'),
+                      dash.dependencies.Input('region-dropdown', 'options'),
+                      dash.dependencies.Input('data-mode', 'value')]
+
+prevalence_inputs = [dash.dependencies.Input('prevalence-region', 'value'),
+                     dash.dependencies.Input('prevalence-year-slider', 'value'),
+                     dash.dependencies.Input('data-mode', 'value')]
+
+def death_rates_z(death_rates_index, rows, col, data_mode):
+    z = rows['rates'][col]
+    if lite.is_lite(data_mode):
+        z = lite.quantize(z, lite.colour_step(choropleth_style['colorscale'], choropleth_style['zmin'],
+                                              death_rates_index.maxima[col]))
+    return z
+
+
+def prevalence_x(values, data_mode):
+    return lite.quantize(values, prevalence_step) if lite.is_lite(data_mode) else values
+
+
+def scope_rows(snapshot, year, scope):
+    ## the year's rows of the map, only the countries the scope shows: a continent's map does not
+    ## need the z and hover text of the other 120 or so. None for the world, which shows them all
+    positions = snapshot.region_index.positions(scope, year)
+    if positions is None:
+        return None
+    rows = snapshot.death_rates_index.year(year)
+    return {'positions': positions,
+            'code': rows['code'][positions],
+            'country': rows['country'][positions],
+            'rates': {col: values[positions] for col, values in rows['rates'].items()}}
+
+@callback_in_mode('full',
+    dash.dependencies.Output('death-rates-graph', 'figure'),
+    death_rates_inputs)
+def update_death_rates_figure(selected_drug, selected_year, selected_scope, options, data_mode):
+    snapshot = store.snapshot
+    death_rates_index = snapshot.death_rates_index
+    col = drug_columns.get(selected_drug)
+    rows = scope_rows(snapshot, selected_year, selected_scope) or death_rates_index.year(selected_year)
+
+    trace = [dict(choropleth_template,
+                  locations=rows['code'],
+                  z=death_rates_z(death_rates_index, rows, col, data_mode),
+                  zmax=death_rates_index.maxima[col],
+                  text=rows['country'],
+                  name=str(selected_year))]
+
+    title = death_rates_title(selected_drug, selected_year, selected_scope, options)
+
+    return {'data': trace, 'layout': death_rates_layout(title, selected_scope)}
+
+@callback_in_mode('full',
     [dash.dependencies.Output('prevalence-graph', 'figure'),
     dash.dependencies.Output('prevalence-title','children')],
-    [dash.dependencies.Input('prevalence-region', 'value'),
-     dash.dependencies.Input('prevalence-year-slider', 'value')])
-def update_prevalence_figure(selected_region, selected_year):
-    disorder_age_sex_female = disorder_age_sex[(disorder_age_sex.sex == 'Female')
-                                               & (disorder_age_sex.year == selected_year)
-                                               & (disorder_age_sex.location == selected_region)]
-
-    disorder_age_sex_male = disorder_age_sex[(disorder_age_sex.sex == 'Male')
-                                             & (disorder_age_sex.year == selected_year)
-                                             & (disorder_age_sex.location == selected_region)]
-
-    trace = [go.Bar(x=disorder_age_sex_female.val,
-                    y=disorder_age_sex_female.age,
-                    name='Female',
-                    orientation='h',
-                    marker=dict(color='rgb(146,197,222)',
-                    line=dict(color='Darkblue'))),
+    prevalence_inputs)
+def update_prevalence_figure(selected_region, selected_year, data_mode):
+    prevalence = store.snapshot.prevalence_index.get(selected_region, selected_year)
+    female = prevalence['Female']
+    male = prevalence['Male']
+
+    trace = [dict(prevalence_bar_templates[0],
+                  x=prevalence_x(female['val'], data_mode),
+                  y=female['age']),
 
-            go.Bar(x= disorder_age_sex_male.val,
-                   y= disorder_age_sex_male.age,
-                   name='Male',
-                   orientation ='h',
-                   marker=dict(color='rgb(8,64,129)',
-                   line=dict(color='DarkBlue')))]
+             dict(prevalence_bar_templates[1],
+                  x=prevalence_x(male['val'], data_mode),
+                  y=male['age'])]
 
-    title = "Share of population within each age category suffering from drug use disorders in {}, {}".format(selected_year, selected_region)
+    title = prevalence_title(selected_region, selected_year)
 
     return {'data': trace, 'layout': layout_prev}, title
 
+@callback_in_mode('patch',
+    dash.dependencies.Output('death-rates-patch', 'data'),
+    death_rates_inputs)
+def update_death_rates_patch(selected_drug, selected_year, selected_scope, options, data_mode):
+    snapshot = store.snapshot
+    death_rates_index = snapshot.death_rates_index
+    col = drug_columns.get(selected_drug)
+    scoped = scope_rows(snapshot, selected_year, selected_scope)
+    rows = scoped or death_rates_index.year(selected_year)
+
+    trace = {'z': death_rates_z(death_rates_index, rows, col, data_mode),
+             'zmax': death_rates_index.maxima[col],
+             'name': str(selected_year)}
+    if scoped is not None and death_rates_index.shared_locations and lite.is_lite(data_mode):
+        # the page has every code and name already, figure_patch.js picks the scope's by position
+        trace['positions'] = scoped['positions']
+    elif scoped is not None or not death_rates_index.shared_locations:
+        trace.update(locations=rows['code'], text=rows['country'])
+
+    title = death_rates_title(selected_drug, selected_year, selected_scope, options)
+
+    return {'data': [trace], 'layout': {'title': title, 'geo': death_rates_geo(selected_scope)}}
+
+@callback_in_mode('patch',
+    [dash.dependencies.Output('prevalence-patch', 'data'),
+    dash.dependencies.Output('prevalence-title','children')],
+    prevalence_inputs)
+def update_prevalence_patch(selected_region, selected_year, data_mode):
+    prevalence_index = store.snapshot.prevalence_index
+    prevalence = prevalence_index.get(selected_region, selected_year)
+
+    traces = []
+    for sex in ('Female', 'Male'):
+        trace = {'x': prevalence_x(prevalence[sex]['val'], data_mode)}
+        if not prevalence_index.shared_ages:
+            trace['y'] = prevalence[sex]['age']
+        traces.append(trace)
+
+    return {'data': traces}, prevalence_title(selected_region, selected_year)
+
+@callback_in_mode('preload',
+    dash.dependencies.Output('death-rates-preload', 'data'),
+    [dash.dependencies.Input('drug_type-dropdown', 'value')])
+def update_death_rates_series(selected_drug):
+    death_rates_index = store.snapshot.death_rates_index
+    years = death_rates_index.years
+    col = drug_columns.get(selected_drug)
+    rows = [death_rates_index.year(y) for y in years]
+
+    series = {'years': years,
+              'z': encode_series([r['rates'][col] for r in rows]),
+              'zmax': death_rates_index.maxima[col],
+              'geo': death_rates_geo(None),
+              'title': death_rates_title_format.format(drug=drug_titles.get(col), year='{year}', scope='{scope}')}
+    if not death_rates_index.shared_locations:
+        series.update(locations=[r['code'] for r in rows], text=[r['country'] for r in rows])
+
+    return series
+
+@callback_in_mode('preload',
+    dash.dependencies.Output('prevalence-preload', 'data'),
+    [dash.dependencies.Input('prevalence-region', 'value')])
+def update_prevalence_series(selected_region):
+    snapshot = store.snapshot
+    prevalence_index = snapshot.prevalence_index
+    years = snapshot.prevalence_years
+    prevalence = [prevalence_index.get(selected_region, y) for y in years]
+
+    series = {'years': years,
+              'x': [encode_series([p[sex]['val'] for p in prevalence]) for sex in ('Female', 'Male')],
+              'title': prevalence_title_format.format(year='{year}', region=selected_region)}
+    if not prevalence_index.shared_ages:
+        series['y'] = [[p[sex]['age'] for p in prevalence] for sex in ('Female', 'Male')]
+
+    return series
+
+if figure_updates == 'patch':
+    for name in ('death-rates', 'prevalence'):
+        app.clientside_callback(
+            ClientsideFunction(namespace='figure_patch', function_name='apply'),
+            dash.dependencies.Output(name + '-graph', 'figure'),
+            [dash.dependencies.Input(name + '-patch', 'data')],
+            [dash.dependencies.State(name + '-base', 'data')])
+
+if figure_updates == 'preload':
+    app.clientside_callback(
+        ClientsideFunction(namespace='figure_series', function_name='death_rates'),
+        dash.dependencies.Output('death-rates-graph', 'figure'),
+        [dash.dependencies.Input('death-rates-preload', 'data'),
+         dash.dependencies.Input('death-rates-year-slider', 'value'),
+         dash.dependencies.Input('region-dropdown', 'value'),
+         dash.dependencies.Input('region-dropdown', 'options')],
+        [dash.dependencies.State('death-rates-base', 'data')])
+    app.clientside_callback(
+        ClientsideFunction(namespace='figure_series', function_name='prevalence'),
+        [dash.dependencies.Output('prevalence-graph', 'figure'),
+         dash.dependencies.Output('prevalence-title', 'children')],
+        [dash.dependencies.Input('prevalence-preload', 'data'),
+         dash.dependencies.Input('prevalence-year-slider', 'value')],
+        [dash.dependencies.State('prevalence-base', 'data')])
+
 @app.callback(
     [dash.dependencies.Output('drug_use', 'figure'),
      dash.dependencies.Output('drug-use-title','children'),
@@ -589,27 +854,112 @@ def update_prevalence_figure(selected_region, selected_year):
     [dash.dependencies.Input('age-slider', 'value')])
 def update_drug_use(selected_age):
     #bar chart
-    age = [i for v,i in age_dict.items() if v==selected_age][0]
-    i = usage.index[min(range(len(usage.index)),key = lambda i: abs(sorted(usage.index)[i]-float(age)))]
+    row = store.snapshot.drug_use_index.get(selected_age)
 
-    trace_bar=[go.Bar(
-                    x=usage_transformed.loc[i, :].sort_values(),
-                    y=usage_transformed.loc[i, :].sort_values().keys(),
-                    name='{} yrs'.format(i),
-                    orientation='h',
-                    marker=dict(color=[np.log(x + 0.1) for x in
-                                usage.loc[i, :].sort_values().values],
-                                colorscale='PuBu',
-                                line=dict(color='DarkBlue',width=0.8)
-                                ),
-                    hovertemplate="%{x:.1%} | %{y}"
+    trace_bar=[dict(drug_use_bar_template,
+                    x=row['shares'],
+                    y=row['drugs'],
+                    name='{} yrs'.format(row['age']),
+                    marker=dict(drug_use_bar_template['marker'], color=row['colours'])
                 )]
-    x = drug_use.iloc[selected_age,0]
-    title = "Share of {} year old who admitted using the following drugs in the past year ".format(int(i))
+    title = "Share of {} year old who admitted using the following drugs in the past year ".format(int(row['age']))
 
-    subtitle = "% of {:,} surveyee in the US, 2012 (log scale)".format(x)
+    subtitle = "% of {:,} surveyee in the US, 2012 (log scale)".format(row['respondents'])
 
     return {'data':trace_bar,'layout':layout_us_bar}, title, subtitle
 
+def callback_domains():
+    ## every input combination the layout can send to each callback, keyed by callback name
+    snapshot = store.snapshot
+    years, regions_dict, age_dict = snapshot.years, snapshot.regions_dict, snapshot.age_dict
+    prevalence_years = snapshot.prevalence_years
+    death_rates = [(d['value'], y, s['value'], scope_options, m)
+                   for d in drug_options for y in years for s in scope_options for m in lite.MODES]
+    prevalence = [(r['value'], y, m) for r in regions_dict for y in prevalence_years for m in lite.MODES]
+    return {
+        'update_death_rates_figure': death_rates,
+        'update_death_rates_patch': death_rates,
+        'update_prevalence_figure': prevalence,
+        'update_prevalence_patch': prevalence,
+        'update_death_rates_series': [(d['value'],) for d in drug_options],
+        'update_prevalence_series': [(r['value'],) for r in regions_dict],
+        'update_drug_use': [(a,) for a in sorted(age_dict)]
+    }
+
+## callback latency, size and error metrics on /metrics, labelled by these inputs (name -> argument position)
+
+callback_labels = {
+    'update_death_rates_figure': {'drug': 0, 'scope': 2},
+    'update_death_rates_patch': {'drug': 0, 'scope': 2},
+    'update_death_rates_series': {'drug': 0},
+    'update_prevalence_figure': {'region': 0},
+    'update_prevalence_patch': {'region': 0},
+    'update_prevalence_series': {'region': 0}
+}
+
+# the values each label may take, the options the page offers; anything else is counted as 'other'
+drug_values = {d['value'] for d in drug_options}
+scope_values = {s['value'] for s in scope_options}
+label_values = {
+    'drug': lambda: drug_values,
+    'scope': lambda: scope_values,
+    'region': lambda: store.snapshot.region_values
+}
+
+## callback name -> (dataset it reads, position of its year argument, None when it reads every year)
+
+callback_datasets = {
+    'update_death_rates_figure': ('death_rates', 1),
+    'update_death_rates_patch': ('death_rates', 1),
+    'update_death_rates_series': ('death_rates', None),
+    'update_prevalence_figure': ('disorder_age_sex', 1),
+    'update_prevalence_patch': ('disorder_age_sex', 1),
+    'update_prevalence_series': ('disorder_age_sex', None),
+    'update_drug_use': ('drug_use', None)
+}
+
+figure_cache = FigureCache(settings.FIGURE_CACHE_BYTES)
+single_flight = SingleFlight(settings.CALLBACK_WORKERS, settings.CALLBACK_TIMEOUT)
+callback_metrics = CallbackMetrics(callback_labels, label_values, cache=figure_cache, single_flight=single_flight,
+                                   profile_rate=settings.PROFILE_SAMPLE_RATE,
+                                   profile_dir=settings.PROFILE_DIR,
+                                   profile_keep=settings.PROFILE_KEEP)
+
+## serve repeat requests from already-serialized (and already-compressed) responses;
+## pre-rendered responses already are, straight from disk. On a cache miss, concurrent
+## identical requests share one build on the SingleFlight pool, serialized by serialize.dumps,
+## then compressed and stored once by figure_cache.build.
+
+if prerendered is not None:
+    wrap_callbacks(app, prerendered.wrap)
+else:
+    wrap_callbacks(app, serialize.wrap)
+    wrap_callbacks(app, callback_metrics.profile)
+    wrap_callbacks(app, figure_cache.build)
+    wrap_callbacks(app, single_flight.wrap)
+    wrap_callbacks(app, figure_cache.wrap)
+wrap_callbacks(app, callback_metrics.wrap)
+callback_metrics.add_route(server)
+
+## reload the data when the CSVs change, checked every DATA_RELOAD_INTERVAL seconds by each worker
+## (started on its first request, after gunicorn has forked) or on POST /admin/reload
+
+if prerendered is None:
+    if settings.DATA_RELOAD_INTERVAL:
+        server.before_first_request(lambda: store.watch(settings.DATA_RELOAD_INTERVAL))
+    if settings.RELOAD_TOKEN:
+        store.add_route(server, settings.RELOAD_TOKEN)
+
+## CSV downloads of the data behind the charts on /export/ (see export.py)
+
+if prerendered is None:
+    # export reads the indexes, which load pandas, so the pre-rendered app does not import it
+    import export
+    export.add_route(server, store, settings.EXPORT_CONCURRENCY)
+
+startup.mark('callbacks')
+if settings.STARTUP_REPORT:
+    sys.stderr.write(startup.format_report() + '\n')
+
 if __name__ == "__main__":
     app.run_server(debug=True)
@@ -0,0 +1,41 @@
+// Merges the partial figures sent by the patch-mode callbacks in app.py into the
+// static base figure that ships with the page.
+//   base:  {data: [trace, ...], layout: {...}}
+//   patch: {data: [changed trace properties, ...], layout: {changed layout properties}}
+// In lite mode a map patch may send positions instead of locations and text: the indices
+// of the countries to show in the base trace's arrays.
+(function() {
+    function pick(values, positions) {
+        return positions.map(function(i) { return values[i]; });
+    }
+
+    function merge(trace, changed) {
+        if (!changed) {
+            return trace;
+        }
+        var merged = Object.assign({}, trace, changed);
+        if (changed.positions) {
+            merged.locations = pick(trace.locations, changed.positions);
+            merged.text = pick(trace.text, changed.positions);
+            delete merged.positions;
+        }
+        return merged;
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        figure_patch: {
+            apply: function(patch, base) {
+                if (!patch) {
+                    return base;
+                }
+                var patchData = patch.data || [];
+                return {
+                    data: base.data.map(function(trace, i) {
+                        return merge(trace, patchData[i]);
+                    }),
+                    layout: Object.assign({}, base.layout, patch.layout)
+                };
+            }
+        }
+    });
+})();
@@ -0,0 +1,77 @@
+// Builds the death rates map and the prevalence bars in the browser from the all-years
+// series sent by the preload-mode callbacks in app.py, so moving a year slider needs no
+// request to the server. Values arrive as base64 float32 (see encoding.encode_series).
+(function() {
+    var decoded = {};
+    var decodedCount = 0;
+
+    function decode(encoded) {
+        if (!(encoded.values in decoded)) {
+            // keep only the few series in use, typed arrays are cheap to rebuild
+            if (decodedCount >= 8) {
+                decoded = {};
+                decodedCount = 0;
+            }
+            var binary = atob(encoded.values);
+            var bytes = new Uint8Array(binary.length);
+            for (var i = 0; i < binary.length; i++) {
+                bytes[i] = binary.charCodeAt(i);
+            }
+            decoded[encoded.values] = new Float32Array(bytes.buffer);
+            decodedCount++;
+        }
+        return decoded[encoded.values];
+    }
+
+    function yearValues(encoded, i) {
+        return decode(encoded).subarray(encoded.offsets[i], encoded.offsets[i + 1]);
+    }
+
+    function yearIndex(series, year) {
+        var i = series.years.indexOf(year);
+        return i < 0 ? 0 : i;
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        figure_series: {
+            death_rates: function(series, year, scope, options, base) {
+                if (!series) {
+                    return base;
+                }
+                var i = yearIndex(series, year);
+                var label = options.filter(function(o) { return o.value === scope; })[0].label;
+                var trace = Object.assign({}, base.data[0], {
+                    z: yearValues(series.z, i),
+                    zmax: series.zmax,
+                    name: String(series.years[i])
+                });
+                if (series.locations) {
+                    trace.locations = series.locations[i];
+                    trace.text = series.text[i];
+                }
+                return {
+                    data: [trace],
+                    layout: Object.assign({}, base.layout, {
+                        title: series.title.replace('{year}', series.years[i]).replace('{scope}', label),
+                        geo: Object.assign({}, series.geo, {scope: scope})
+                    })
+                };
+            },
+            prevalence: function(series, year, base) {
+                if (!series) {
+                    return [base, ''];
+                }
+                var i = yearIndex(series, year);
+                var data = base.data.map(function(trace, sex) {
+                    var update = {x: yearValues(series.x[sex], i)};
+                    if (series.y) {
+                        update.y = series.y[sex][i];
+                    }
+                    return Object.assign({}, trace, update);
+                });
+                return [{data: data, layout: base.layout},
+                        series.title.replace('{year}', series.years[i])];
+            }
+        }
+    });
+})();
@@ -0,0 +1,183 @@
+"""Benchmark the app's callbacks over their full input domains.
+
+    python bench.py                         # print a report
+    python bench.py --save bench.json       # also store it as a baseline
+    python bench.py --compare bench.json    # flag regressions against a baseline
+
+Each callback is driven in-process (the Dash callback function, which builds the
+figure, serialized as the app serializes it) and through the Flask test client against app.server
+(a full _dash-update-component request). Reported per callback: latency
+percentiles, response size and peak memory allocated by one invocation.
+"""
+import argparse
+import gzip
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import serialize
+from dispatch import callback_ids, split_callback_id, update_request_body
+
+# relative increase over the baseline that counts as a regression
+DEFAULT_THRESHOLD = 0.25
+# metrics compared against the baseline; latency below this many ms is noise
+COMPARED = ('p50_ms', 'p95_ms', 'bytes', 'peak_kb')
+MIN_MS = 0.5
+
+
+def _summary(latencies, sizes, gzipped_sizes, peaks):
+    latencies = np.asarray(latencies) * 1000
+    result = {
+        'calls': len(latencies),
+        'mean_ms': float(latencies.mean()),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'bytes': float(np.mean(sizes)),
+        'peak_kb': float(max(peaks)) / 1024
+    }
+    if gzipped_sizes:
+        result['gzip_bytes'] = float(np.mean(gzipped_sizes))
+    return result
+
+
+def _peak_memory(call):
+    tracemalloc.start()
+    try:
+        call()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_in_process(app_module, name, callback_id, domain, repeat):
+    # the module attribute is the function Dash registered, before any cache wrapping
+    func = serialize.wrap(callback_id, getattr(app_module, name))
+    outputs_list = split_callback_id(callback_id)
+    latencies, sizes, peaks = [], [], []
+    for _ in range(repeat):
+        for args in domain:
+            start = time.perf_counter()
+            response = func(*args, outputs_list=outputs_list)
+            latencies.append(time.perf_counter() - start)
+            sizes.append(len(response))
+    for args in domain:
+        peaks.append(_peak_memory(lambda: func(*args, outputs_list=outputs_list)))
+    return _summary(latencies, sizes, [], peaks)
+
+
+def bench_client(app_module, callback_id, domain, repeat, warm):
+    client = app_module.server.test_client()
+    cache = app_module.figure_cache
+    bodies = [update_request_body(app_module.app, callback_id, list(args)) for args in domain]
+
+    def post(body):
+        if not warm:
+            cache.clear()
+        return client.post('/_dash-update-component', json=body, headers={'Accept-Encoding': 'gzip'})
+
+    latencies, sizes, gzipped_sizes, peaks = [], [], [], []
+    for _ in range(repeat):
+        for body in bodies:
+            start = time.perf_counter()
+            response = post(body)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                raise RuntimeError('{} returned {}'.format(callback_id, response.status_code))
+            data = response.get_data()
+            if response.headers.get('Content-Encoding') == 'gzip':
+                gzipped_sizes.append(len(data))
+                data = gzip.decompress(data)
+            sizes.append(len(data))
+    for body in bodies:
+        peaks.append(_peak_memory(lambda: post(body)))
+    return _summary(latencies, sizes, gzipped_sizes, peaks)
+
+
+def run(app_module, repeat=1, limit=None, warm=False):
+    ids = callback_ids(app_module.app)
+    results = {'in_process': {}, 'client': {}}
+    for name, domain in sorted(app_module.callback_domains().items()):
+        if name not in ids:
+            continue
+        domain = domain[:limit] if limit else domain
+        if app_module.prerendered is None:
+            # pre-rendered mode has no data to build figures from in-process
+            results['in_process'][name] = bench_in_process(app_module, name, ids[name], domain, repeat)
+        results['client'][name] = bench_client(app_module, ids[name], domain, repeat, warm)
+    return {
+        'meta': {'python': platform.python_version(), 'figure_updates': app_module.figure_updates,
+                 'repeat': repeat, 'limit': limit, 'warm': warm, 'time': time.time()},
+        'results': results
+    }
+
+
+def compare(report, baseline, threshold=DEFAULT_THRESHOLD):
+    """List the metrics in report that are worse than baseline by more than threshold."""
+    regressions = []
+    for mode, callbacks in report['results'].items():
+        for name, metrics in callbacks.items():
+            old = baseline['results'].get(mode, {}).get(name)
+            if old is None:
+                continue
+            for metric in COMPARED:
+                if metric not in old or metric not in metrics:
+                    continue
+                if metric.endswith('_ms') and metrics[metric] < MIN_MS:
+                    continue
+                if metrics[metric] > old[metric] * (1 + threshold):
+                    regressions.append('{} {} {}: {:.2f} -> {:.2f}'.format(
+                        mode, name, metric, old[metric], metrics[metric]))
+    return regressions
+
+
+def format_report(report):
+    lines = []
+    header = '{:<28} {:>6} {:>9} {:>9} {:>9} {:>10} {:>10} {:>9}'
+    row = '{:<28} {:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>10.0f} {:>10} {:>9.1f}'
+    for mode, callbacks in sorted(report['results'].items()):
+        lines.append(mode)
+        lines.append(header.format('callback', 'calls', 'p50 ms', 'p95 ms', 'p99 ms', 'bytes', 'gzip', 'peak kB'))
+        for name, m in sorted(callbacks.items()):
+            gzipped = '{:.0f}'.format(m['gzip_bytes']) if 'gzip_bytes' in m else '-'
+            lines.append(row.format(name, m['calls'], m['p50_ms'], m['p95_ms'], m['p99_ms'],
+                                    m['bytes'], gzipped, m['peak_kb']))
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the app's callbacks.")
+    parser.add_argument('--repeat', type=int, default=1, help='passes over each input domain')
+    parser.add_argument('--limit', type=int, help='only the first N inputs of each domain')
+    parser.add_argument('--warm', action='store_true', help='keep the figure cache between requests')
+    parser.add_argument('--save', metavar='FILE', help='write the report as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='baseline JSON to check for regressions')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='relative increase counted as a regression (default %(default)s)')
+    args = parser.parse_args()
+
+    import app
+    report = run(app, repeat=args.repeat, limit=args.limit, warm=args.warm)
+    print(format_report(report))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            return 1
+        print('no regressions against {}'.format(args.compare))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
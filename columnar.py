@@ -0,0 +1,157 @@
+import contextlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+## A small columnar on-disk format for cleaned frames: one .npy file per column plus meta.json.
+## Text columns are stored as integer codes with their categories kept in meta.json, so every
+## file on disk is a plain numeric array that np.load can memory-map instead of parsing.
+
+META_FILE = 'meta.json'
+FORMAT_VERSION = 1
+
+
+def _source_stamp(source):
+    if isinstance(source, (list, tuple)):
+        return [_source_stamp(path) for path in source]
+    stat = os.stat(source)
+    return {'path': source, 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def _stamp_matches(stamp, source):
+    if isinstance(source, (list, tuple)):
+        return len(stamp) == len(source) and all(_stamp_matches(s, path) for s, path in zip(stamp, source))
+    if not os.path.exists(source):
+        # the app needs its CSVs, datastore.source_stamps watches them, so a copy is never
+        # used without its source: loading falls back to the CSV and fails naming it
+        return False
+    current = _source_stamp(source)
+    return stamp['size'] == current['size'] and stamp['mtime'] == current['mtime']
+
+
+@contextlib.contextmanager
+def _replacing(path):
+    """A new directory to write path's files into, swapped in for path at the end of the block.
+
+    The files under path are never written over: worker processes may have them memory-mapped,
+    and rewriting a mapped file in place shows them shifted rows or kills them with SIGBUS.
+    After the rename those mappings keep the old files until they are unmapped.
+    """
+    parent = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    staging = tempfile.mkdtemp(prefix=os.path.basename(path) + '.', dir=parent)
+    os.chmod(staging, 0o755)
+    try:
+        yield staging
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    retired = None
+    if os.path.exists(path):
+        retired = staging + '.old'
+        os.rename(path, retired)
+    os.rename(staging, path)
+    if retired is not None:
+        shutil.rmtree(retired)
+
+
+def _write_column(values, path):
+    if values.dtype == object or pd.api.types.is_categorical_dtype(values.dtype):
+        categorical = pd.Categorical(values)
+        codes = categorical.codes
+        np.save(path, codes.astype(np.int16 if len(categorical.categories) < 2 ** 15 else np.int32))
+        return {'kind': 'categorical', 'categories': categorical.categories.tolist()}
+    np.save(path, np.ascontiguousarray(np.asarray(values)))
+    return {'kind': 'numeric'}
+
+
+def _read_column(spec, path, mmap_mode):
+    values = np.load(path, mmap_mode=mmap_mode)
+    if spec['kind'] == 'categorical':
+        return pd.Categorical.from_codes(values, categories=spec['categories'])
+    # a plain ndarray view of the mapped file, no copy
+    return values.view(np.ndarray) if isinstance(values, np.memmap) else values
+
+
+def write_frame(df, path, source=None):
+    """Write df to the directory path, recording the CSV it was cleaned from."""
+    with _replacing(path) as staging:
+        columns = []
+        for i, name in enumerate(df.columns):
+            spec = _write_column(df[name], os.path.join(staging, 'c{}.npy'.format(i)))
+            spec['name'] = name
+            columns.append(spec)
+        index = None
+        if not isinstance(df.index, pd.RangeIndex):
+            index = _write_column(df.index.to_series(), os.path.join(staging, 'index.npy'))
+            index['name'] = df.index.name
+        meta = {'version': FORMAT_VERSION, 'rows': len(df), 'columns': columns, 'index': index,
+                'source': _source_stamp(source) if source else None}
+        with open(os.path.join(staging, META_FILE), 'w') as f:
+            json.dump(meta, f)
+
+
+def read_meta(path):
+    try:
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+    except (IOError, ValueError):
+        return None
+    return meta if meta.get('version') == FORMAT_VERSION else None
+
+
+def is_fresh(path, source):
+    """True when path holds data written from the current contents of source, a path or list of paths.
+
+    False when a source is missing.
+    """
+    meta = read_meta(path)
+    if meta is None:
+        return False
+    return meta['source'] is None or _stamp_matches(meta['source'], source)
+
+
+def read_frame(path, mmap_mode='r'):
+    """Load a frame written by write_frame, memory-mapping the column files."""
+    meta = read_meta(path)
+    data = {}
+    for i, spec in enumerate(meta['columns']):
+        data[spec['name']] = _read_column(spec, os.path.join(path, 'c{}.npy'.format(i)), mmap_mode)
+    index = None
+    if meta['index'] is not None:
+        index = pd.Index(_read_column(meta['index'], os.path.join(path, 'index.npy'), mmap_mode),
+                         name=meta['index']['name'])
+    return pd.DataFrame(data, index=index, columns=[spec['name'] for spec in meta['columns']])
+
+
+def write_arrays(arrays, path, source=None):
+    """Write a dict of 1-d arrays of any lengths to the directory path.
+
+    Used for the precomputed indexes, whose arrays are not columns of one frame.
+    """
+    with _replacing(path) as staging:
+        specs = []
+        for i, name in enumerate(sorted(arrays)):
+            spec = _write_column(np.asarray(arrays[name]), os.path.join(staging, 'a{}.npy'.format(i)))
+            spec['name'] = name
+            specs.append(spec)
+        meta = {'version': FORMAT_VERSION, 'arrays': specs, 'source': _source_stamp(source) if source else None}
+        with open(os.path.join(staging, META_FILE), 'w') as f:
+            json.dump(meta, f)
+
+
+def read_arrays(path, mmap_mode='r'):
+    """Load arrays written by write_arrays: numeric arrays memory-mapped, text arrays as object arrays."""
+    meta = read_meta(path)
+    arrays = {}
+    for i, spec in enumerate(meta['arrays']):
+        values = _read_column(spec, os.path.join(path, 'a{}.npy'.format(i)), mmap_mode)
+        if spec['kind'] == 'categorical':
+            values = np.asarray(values, dtype=object)
+        arrays[spec['name']] = values
+    return arrays
@@ -0,0 +1,203 @@
+import os
+
+import pandas as pd
+
+import columnar
+import settings
+from indexes import DeathRatesIndex, FactTable, PrevalenceIndex
+
+## Loading and cleaning of the CSVs under data/ used by app.py.
+## preprocess.py stores the cleaned frames, and the indexes built from them, in the columnar
+## format; load() and load_index() prefer those and only parse the CSV when no up to date
+## copy exists.
+
+
+def read_drug_use_csv(path):
+    # loading drug use dataset
+    drug_use = pd.read_csv(path)
+
+    # '-' spotted, replaced with 0 as linked to use value which equals zero in this instance
+    drug_use.replace('-','0',inplace=True)
+
+    # Range in age replaced with means of range values to enable use in calculation
+    # as object type not accepted
+    drug_use.age.replace({'22-23':'22.5','24-25':'24.5','26-29':'27.5','30-34':'32',
+                          '35-49':'42','50-64':'57','65+':'65'},inplace=True)
+
+
+    # set variable types
+    for col in drug_use.select_dtypes(include=['object']).columns:
+        drug_use[col] = drug_use[col].astype('float')
+
+    drug_use.set_index('age',inplace=True)
+
+    return drug_use
+
+
+def split_drug_use(drug_use):
+    ## Creating a DF with the use, setting 'age' as index and removing -use in column names
+
+    usage = drug_use[(drug_use.columns.values[drug_use.columns.str.contains('use')])]
+    usage.columns = usage.columns.str.replace('-use','')
+
+    usage_transformed = usage.apply(lambda x: x/100)
+
+    ## Creating a DF with the frequency, removing -frequency in column names
+
+    frequency = drug_use[(drug_use.columns.values[drug_use.columns.str.contains('freq')])]
+
+    frequency.columns = frequency.columns.str.replace('-frequency','')
+
+    for col in frequency.columns:
+        frequency[col] = frequency[col].astype('int')
+
+    return usage, usage_transformed, frequency
+
+
+def read_death_rates_csv(path):
+    return pd.read_csv(path)
+
+
+def read_mental_health_csv(path):
+    return pd.read_csv(path)
+
+
+def read_disorder_age_sex_csv(path):
+    #. http://ghdx.healthdata.org/gbd-results-tool?params=gbd-api-2017-permalink/3c5c2b8846e4b1ecae4a9eb461e9a193
+
+    disorder_age_sex = pd.read_csv(path)
+    disorder_age_sex = disorder_age_sex[['location','sex','age','year','val']]
+    disorder_age_sex.replace('Global','World',inplace=True)
+    return disorder_age_sex.replace('5-14 years','05-14').replace('70+ years','70+').sort_values(by='age')
+
+
+def read_continents_csv(path):
+    # code, continent, and the bounding box of the country in degrees: west, south, east, north
+    return pd.read_csv(path)
+
+
+def read_population_csv(path):
+    # the Gapminder population column, one row per country and year it is known for
+    population = pd.read_csv(path).rename(columns={'Code': 'code', 'Year': 'year',
+                                                   'Total population (Gapminder)': 'population'})
+    return population[['code', 'year', 'population']].dropna().reset_index(drop=True)
+
+
+## name -> (source CSV, cleaning function)
+
+DATASETS = {
+    'drug_use': ('data/drug-use-by-age.csv', read_drug_use_csv),
+    'death_rates': ('data/global_df.csv', read_death_rates_csv),
+    'mental_health': ('data/mental-health-as-risk-for-drug-dependency.csv', read_mental_health_csv),
+    'disorder_age_sex': ('data/my_data.csv', read_disorder_age_sex_csv),
+    'continents': ('data/country-continents.csv', read_continents_csv),
+    'population': ('data/prevalence-of-drug-use-disorders-males-vs-females.csv', read_population_csv),
+}
+
+
+def load(name):
+    source, read_csv = DATASETS[name]
+    path = os.path.join(settings.COLUMNAR_DIR, name)
+    if columnar.is_fresh(path, source):
+        return columnar.read_frame(path)
+    return read_csv(source)
+
+
+## dataset name -> index built from it. Loaded indexes memory-map their arrays, so every
+## worker process shares one copy of the data through the page cache.
+
+INDEXES = {
+    'death_rates': DeathRatesIndex,
+    'disorder_age_sex': PrevalenceIndex,
+}
+
+
+def _index_path(out_dir, name):
+    return os.path.join(out_dir, name + '.index')
+
+
+def load_index(name):
+    source, _ = DATASETS[name]
+    path = _index_path(settings.COLUMNAR_DIR, name)
+    if columnar.is_fresh(path, source):
+        return INDEXES[name].load(path)
+    return INDEXES[name].from_frame(load(name))
+
+
+## source CSV -> {metric: {CSV column: dimension}} for the fact table.
+## The four death-rate-*.csv files are the columns global_df.csv was merged from,
+## so death_rate is read from global_df.csv alone.
+
+FACT_SOURCES = {
+    'data/global_df.csv': {
+        'death_rate': {'all_rate': 'all', 'amphetamine_rate': 'amphetamine',
+                       'cocaine_rate': 'cocaine', 'opioid_rate': 'opioid'}},
+    'data/deaths-drug-overdoses.csv': {
+        'overdose_deaths': {'Opioids (deaths)': 'opioids', 'Cocaine (deaths)': 'cocaine',
+                            'Other drugs (deaths)': 'other', 'Amphetamine (deaths)': 'amphetamine'}},
+    'data/deaths-from-drug-use-disorders-by-age.csv': {
+        'disorder_deaths_by_age': {'Under-5s (deaths)': 'under 5', '5-14 years (Number)': '5-14',
+                                   '15-49 years (deaths)': '15-49', '50-69 years (deaths)': '50-69',
+                                   '70+ years (deaths)': '70+'}},
+    'data/deaths-illicit-drugs.csv': {
+        'illicit_drug_deaths': {'Drug overdoses (direct) (deaths)': 'overdoses',
+                                'Drug use (risk factor) (deaths)': 'risk factor'}},
+    'data/prevalence-of-drug-use-disorders-by-age.csv': {
+        'prevalence_by_age': {'5-14 years old (%)': '5-14', '10-14 years old (%)': '10-14',
+                              '15-19 years old (%)': '15-19', '20-24 years old (%)': '20-24',
+                              '25-29 years old (%)': '25-29', '30-34 years old (%)': '30-34',
+                              '15-49 years old (%)': '15-49', '70+ years old (%)': '70+',
+                              'All ages (%)': 'all ages', 'Age-standardized (%)': 'age-standardized'}},
+    'data/prevalence-of-drug-use-disorders-males-vs-females.csv': {
+        'prevalence_by_sex': {'Share of males (%)': 'male', 'Share of females (%)': 'female'},
+        'population': {'Total population (Gapminder)': 'total'}},
+    'data/share-with-drug-use-disorders.csv': {
+        'prevalence': {'Prevalence - Drug use disorders - Sex: Both - Age: Age-standardized (Percent) (%)':
+                       'age-standardized'}},
+}
+
+FACT_COLUMNS = ['entity', 'code', 'year', 'metric', 'dimension', 'value']
+
+
+def read_facts():
+    """Reshape every FACT_SOURCES CSV into one long frame with FACT_COLUMNS."""
+    parts = []
+    for path, metrics in sorted(FACT_SOURCES.items()):
+        wide = pd.read_csv(path).rename(columns={'Entity': 'entity', 'country': 'entity',
+                                                 'Code': 'code', 'Year': 'year'})
+        for metric, dimensions in sorted(metrics.items()):
+            long = wide.melt(id_vars=['entity', 'code', 'year'], value_vars=list(dimensions),
+                             var_name='dimension', value_name='value')
+            # the Gapminder columns go back centuries with gaps, keep only the values present
+            long = long.dropna(subset=['value'])
+            long['dimension'] = long['dimension'].map(dimensions)
+            long['metric'] = metric
+            parts.append(long[FACT_COLUMNS])
+    return pd.concat(parts, ignore_index=True)
+
+
+def load_facts():
+    sources = sorted(FACT_SOURCES)
+    path = os.path.join(settings.COLUMNAR_DIR, 'facts')
+    if columnar.is_fresh(path, sources):
+        return FactTable.load(path)
+    return FactTable.from_frame(read_facts())
+
+
+def preprocess(out_dir=None):
+    """Clean every dataset and write it, and its index, in the columnar format.
+
+    Returns the names written.
+    """
+    out_dir = out_dir or settings.COLUMNAR_DIR
+    written = []
+    for name, (source, read_csv) in sorted(DATASETS.items()):
+        frame = read_csv(source)
+        columnar.write_frame(frame, os.path.join(out_dir, name), source=source)
+        written.append(name)
+        if name in INDEXES:
+            INDEXES[name].from_frame(frame).save(_index_path(out_dir, name), source=source)
+            written.append(name + '.index')
+    FactTable.from_frame(read_facts()).save(os.path.join(out_dir, 'facts'), source=sorted(FACT_SOURCES))
+    written.append('facts')
+    return written
@@ -0,0 +1,174 @@
+import hashlib
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+
+import flask
+
+## The data the app serves, versioned so it can be replaced while the app runs.
+## Everything the layout and the callbacks read from data/ hangs off one Snapshot. A reload
+## builds the next Snapshot in the background, reusing the parts whose files did not change,
+## and swaps it in with a single assignment, so each request sees either the old data or the
+## new one, never a mix. Callbacks read DataStore.snapshot once and use that throughout.
+
+
+class Snapshot(object):
+    """One version of the data, with its parts as attributes. Not modified once published."""
+
+    def __init__(self, version, stamps=None, **parts):
+        self.version = version
+        self.stamps = stamps
+        self.__dict__.update(parts)
+
+
+def source_stamps():
+    """name -> [size, mtime] of every source CSV, the identity of a version of the data.
+
+    The fact table, read from several CSVs, has a [size, mtime] for each under 'facts'.
+    """
+    import data
+    stamps = {}
+    for name, (source, _) in sorted(data.DATASETS.items()):
+        stamps[name] = _stamp(source)
+    stamps['facts'] = [_stamp(source) for source in sorted(data.FACT_SOURCES)]
+    return stamps
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+
+def _version(stamps):
+    return hashlib.sha1(json.dumps(stamps, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+
+def load_snapshot(previous=None):
+    """Snapshot of the CSVs as they are now, reusing previous's parts for files that have not changed."""
+    # imported here, data and indexes load pandas, which the pre-rendered app does not need
+    import data
+    from indexes import DrugUseIndex, RegionIndex
+
+    stamps = source_stamps()
+    changed = {name for name in stamps if previous is None or previous.stamps.get(name) != stamps[name]}
+    parts = {}
+
+    if 'drug_use' in changed:
+        drug_use = data.load('drug_use')
+        usage, usage_transformed, frequency = data.split_drug_use(drug_use)
+        age_dict = {x: str(round(i)) for x, i in enumerate(drug_use.index)}
+        parts.update(age_dict=age_dict,
+                     drug_use_index=DrugUseIndex(drug_use, usage, usage_transformed, age_dict))
+    else:
+        parts.update(age_dict=previous.age_dict, drug_use_index=previous.drug_use_index)
+
+    parts['mental_health'] = data.load('mental_health') if 'mental_health' in changed else previous.mental_health
+
+    # the index of a changed dataset is rebuilt whole, it is only slices of its sorted columns
+    for name, attribute in (('death_rates', 'death_rates_index'), ('disorder_age_sex', 'prevalence_index')):
+        parts[attribute] = data.load_index(name) if name in changed else getattr(previous, attribute)
+
+    for name in ('continents', 'population'):
+        parts[name] = data.load(name) if name in changed else getattr(previous, name)
+    # served by /export/facts.csv only, no callback reads it
+    parts['facts'] = data.load_facts() if 'facts' in changed else previous.facts
+    if changed & {'death_rates', 'continents', 'population'}:
+        parts['region_index'] = RegionIndex(parts['death_rates_index'], parts['continents'], parts['population'])
+    else:
+        parts['region_index'] = previous.region_index
+
+    parts['years'] = parts['death_rates_index'].years
+    # my_data.csv and global_df.csv may gain a year in separate reloads
+    parts['prevalence_years'] = parts['prevalence_index'].years
+    parts['regions_dict'] = [{'label': i, 'value': i} for i in parts['prevalence_index'].locations]
+    parts['region_values'] = set(parts['prevalence_index'].locations)
+    return Snapshot(_version(stamps), stamps, **parts)
+
+
+def changes(previous, snapshot):
+    """dataset name -> years whose values differ between two snapshots, or None for all years.
+
+    Datasets missing from the result are unchanged.
+    """
+    result = {}
+    if snapshot.drug_use_index is not previous.drug_use_index:
+        result['drug_use'] = None
+    if snapshot.mental_health is not previous.mental_health:
+        result['mental_health'] = None
+    if snapshot.death_rates_index is not previous.death_rates_index:
+        result['death_rates'] = snapshot.death_rates_index.changed_years(previous.death_rates_index)
+    if snapshot.prevalence_index is not previous.prevalence_index:
+        result['disorder_age_sex'] = snapshot.prevalence_index.changed_years(previous.prevalence_index)
+    if snapshot.continents is not previous.continents:
+        # which countries each scope of the map shows, in every year
+        result['death_rates'] = None
+    return result
+
+
+class DataStore(object):
+    """Holds the current Snapshot and replaces it when the files under data/ change.
+
+    build(previous) returns a new Snapshot; on_swap(changes) runs after each swap so
+    caches can drop what the new data made stale.
+    """
+
+    def __init__(self, build, on_swap=None):
+        self._build = build
+        self._on_swap = on_swap
+        self._lock = threading.Lock()
+        self._watcher = None
+        self.snapshot = build(None)
+
+    def reload(self):
+        """Load the data again if a source file changed. Returns the changes, None if there were none."""
+        with self._lock:
+            previous = self.snapshot
+            if previous.stamps is None or source_stamps() == previous.stamps:
+                return None
+            snapshot = self._build(previous)
+            self.snapshot = snapshot
+            swapped = changes(previous, snapshot)
+            if self._on_swap is not None:
+                self._on_swap(swapped)
+            return swapped
+
+    def _reload_reporting_errors(self):
+        try:
+            return self.reload()
+        except Exception as e:
+            # a half-written or malformed file: keep serving the current snapshot
+            sys.stderr.write('data reload failed, still serving {}: {!r}\n'.format(self.snapshot.version, e))
+
+    def watch(self, interval):
+        """Check the data files every interval seconds from a daemon thread, once per process."""
+        with self._lock:
+            if self._watcher is not None:
+                return
+
+            def poll():
+                while True:
+                    time.sleep(interval)
+                    self._reload_reporting_errors()
+
+            self._watcher = threading.Thread(target=poll, name='data-watcher', daemon=True)
+            self._watcher.start()
+
+    def add_route(self, server, token, path='/admin/reload'):
+        """POST path with the header X-Reload-Token: token to reload without waiting for the watcher."""
+
+        def reload_now():
+            given = flask.request.headers.get('X-Reload-Token', '')
+            if not hmac.compare_digest(given.encode('utf-8'), token.encode('utf-8')):
+                flask.abort(403)
+            try:
+                swapped = self.reload()
+            except Exception as e:
+                return flask.jsonify(error=repr(e), version=self.snapshot.version), 500
+            if swapped is not None:
+                swapped = {name: None if years is None else sorted(years) for name, years in swapped.items()}
+            return flask.jsonify(version=self.snapshot.version, changed=swapped)
+
+        server.add_url_rule(path, 'reload_data', reload_now, methods=['POST'])
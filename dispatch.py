@@ -0,0 +1,70 @@
+import json
+import zlib
+
+import flask
+from dash._utils import split_callback_id
+
+import settings
+
+## Helpers for wrapping the callbacks Dash dispatches to.
+## Dash looks callbacks up in app.callback_map on every _dash-update-component request,
+## so wrapping the entries there covers every callback registered with @app.callback.
+
+
+def callback_key(callback_id, args):
+    """A stable string key for one invocation of a callback."""
+    return '{}|{}'.format(callback_id, json.dumps(args, sort_keys=True, separators=(',', ':')))
+
+
+def wrap_callbacks(app, wrapper):
+    """Replace each registered callback with wrapper(callback_id, callback).
+
+    Must be called after every @app.callback has been declared. Clientside callbacks
+    have no Python function and are left alone.
+    """
+    for callback_id, entry in app.callback_map.items():
+        if 'callback' in entry:
+            entry['callback'] = wrapper(callback_id, entry['callback'])
+
+
+def callback_ids(app):
+    """Map each callback's function name to the id Dash registered it under."""
+    return {entry['callback'].__name__: callback_id
+            for callback_id, entry in app.callback_map.items() if 'callback' in entry}
+
+
+def gzip_bytes(text):
+    """gzip-compress a response body once, ahead of the requests that will reuse it."""
+    # wbits=31 writes a gzip header with a zero timestamp, so the output is reproducible
+    compressor = zlib.compressobj(settings.GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress(text.encode('utf-8')) + compressor.flush()
+
+
+def accepts_gzip():
+    return flask.has_request_context() and 'gzip' in flask.request.headers.get('Accept-Encoding', '').lower()
+
+
+def encoded_response(text, gzipped):
+    """Return the precompressed body when the client accepts gzip, otherwise the plain text.
+
+    Marking the response with Content-Encoding makes Flask-Compress leave it alone, so
+    no compression work is repeated on the request.
+    """
+    if gzipped is not None and accepts_gzip() and 'dash_response' in flask.g:
+        headers = flask.g.dash_response.headers
+        headers['Content-Encoding'] = 'gzip'
+        headers['Vary'] = 'Accept-Encoding'
+        return gzipped
+    return text
+
+
+def update_request_body(app, callback_id, args):
+    """The JSON body the browser would POST to _dash-update-component for these input values."""
+    entry = app.callback_map[callback_id]
+    return {
+        'output': callback_id,
+        'outputs': split_callback_id(callback_id),
+        'inputs': [dict(spec, value=value) for spec, value in zip(entry['inputs'], args)],
+        'state': [],
+        'changedPropIds': []
+    }
@@ -0,0 +1,19 @@
+import base64
+
+import numpy as np
+
+## Compact encodings for numeric arrays sent to the browser
+
+
+def float32_base64(values):
+    """Little-endian float32 bytes of values, base64 encoded (decoded into a Float32Array client-side)."""
+    return base64.b64encode(np.ascontiguousarray(values, dtype='<f4').tobytes()).decode('ascii')
+
+
+def encode_series(arrays):
+    """Concatenate one array per year into {'values': float32 base64, 'offsets': [...]}.
+
+    Year i's values are values[offsets[i]:offsets[i + 1]].
+    """
+    offsets = np.concatenate([[0], np.cumsum([len(a) for a in arrays])])
+    return {'values': float32_base64(np.concatenate(arrays)), 'offsets': offsets.tolist()}
@@ -0,0 +1,304 @@
+import csv
+import io
+import threading
+
+import flask
+import numpy as np
+
+from indexes import MAP_SCOPES, RATE_COLUMNS
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+## Bulk downloads of the data behind the charts, streamed from the current snapshot's indexes.
+##
+##   GET /export/death_rates.csv?metric=opioid_rate&years=2000-2017&regions=europe,USA
+##   GET /export/prevalence.csv?regions=World&sex=Female&age=15 to 19,20 to 24
+##   GET /export/death_rate_rollups.csv?metric=all_rate&regions=Europe
+##   GET /export/facts.csv?metric=overdose_deaths&years=2010-2017&code=USA,MEX&dimension=opioids
+##
+## Every parameter is optional and takes a comma-separated list; years also takes ranges. Rows
+## are written one year at a time, so an export of everything never holds more than that year's
+## rows in memory. Only a few exports run at once per worker, so downloads cannot take every
+## request thread from the callbacks. With pyarrow installed, .arrow returns an Arrow IPC stream
+## with one record batch per year instead of CSV.
+
+
+class ExportError(ValueError):
+    """A query the export cannot answer, reported to the client as a 400."""
+
+
+def _values(args, name):
+    value = args.get(name)
+    if value is None:
+        return None
+    return [v.strip() for v in value.split(',') if v.strip()]
+
+
+def _choose(args, name, available):
+    chosen = _values(args, name)
+    if chosen is None:
+        return list(available)
+    unknown = [v for v in chosen if v not in available]
+    if unknown:
+        raise ExportError('unknown {}: {}, expected some of {}'.format(name, ', '.join(unknown), ', '.join(map(str, available))))
+    return chosen
+
+
+def _years(args, available):
+    """The years of available named by the years parameter, '1990-1999,2005' say, all of them by default."""
+    chosen = _values(args, 'years')
+    if chosen is None:
+        return list(available)
+    wanted = set()
+    for part in chosen:
+        first, dash, last = part.partition('-')
+        try:
+            first = int(first)
+            last = int(last) if dash else first
+        except ValueError:
+            raise ExportError('years must be years or ranges of years, such as 1990-1999,2005, not {}'.format(part))
+        if last < first:
+            raise ExportError('years range {} runs backwards, write it as {}-{}'.format(part, last, first))
+        wanted.update(range(first, last + 1))
+    return [year for year in available if year in wanted]
+
+
+def _isin(values, wanted):
+    # values is an object array of names, codes or age groups, wanted a set
+    return np.fromiter((v in wanted for v in values), dtype=bool, count=len(values))
+
+
+def _check_parameters(args, allowed):
+    unknown = sorted(set(args) - set(allowed))
+    if unknown:
+        raise ExportError('unknown parameter {}, expected some of {}'.format(', '.join(unknown), ', '.join(allowed)))
+
+
+## exports: each takes the snapshot and the query parameters and returns the column names and a
+## generator of chunks, dicts of equal-length column arrays. The query is checked before the
+## generator is returned, so a bad one is an error response rather than a broken download.
+
+def death_rates(snapshot, args):
+    """Country rows of global_df.csv. regions are country codes, country names or map scopes, world being all."""
+    _check_parameters(args, ('metric', 'years', 'regions'))
+    index, region_index = snapshot.death_rates_index, snapshot.region_index
+    metrics = _choose(args, 'metric', RATE_COLUMNS)
+    years = _years(args, index.years)
+    regions = _values(args, 'regions')
+    if regions is not None and 'world' in regions:
+        regions = None
+    if regions is not None:
+        scopes = [r for r in regions if r in MAP_SCOPES]
+        names = set(regions) - set(scopes)
+        known = set()
+        for year in index.years:
+            rows = index.year(year)
+            known.update(rows['code'].tolist())
+            known.update(rows['country'].tolist())
+        unknown = [r for r in regions if r in names and r not in known]
+        if unknown:
+            raise ExportError('unknown regions: {}, expected map scopes ({}), country codes or country names'.format(
+                ', '.join(unknown), ', '.join(MAP_SCOPES)))
+
+    def chunks():
+        for year in years:
+            rows = index.year(year)
+            keep = slice(None)
+            if regions is not None:
+                keep = _isin(rows['code'], names) | _isin(rows['country'], names)
+                for scope in scopes:
+                    keep[region_index.positions(scope, year)] = True
+            chunk = {'code': rows['code'][keep], 'country': rows['country'][keep]}
+            chunk['year'] = np.full(len(chunk['code']), year)
+            for col in metrics:
+                chunk[col] = rows['rates'][col][keep]
+            yield chunk
+    return ['code', 'country', 'year'] + metrics, chunks()
+
+
+def prevalence(snapshot, args):
+    """Rows of my_data.csv, the prevalence of drug use disorders by location, sex and age."""
+    _check_parameters(args, ('years', 'regions', 'sex', 'age'))
+    index = snapshot.prevalence_index
+    years = _years(args, index.years)
+    locations = _choose(args, 'regions', index.locations)
+    sexes = _choose(args, 'sex', ['Female', 'Male'])
+    ages = _choose(args, 'age', index.ages.tolist())
+    every_age = len(ages) == len(index.ages)
+
+    def chunks():
+        for year in years:
+            parts = []
+            for location in locations:
+                entry = index.get(location, year)
+                for sex in sexes:
+                    age, val = entry[sex]['age'], entry[sex]['val']
+                    if not every_age:
+                        keep = _isin(age, set(ages))
+                        age, val = age[keep], val[keep]
+                    parts.append((location, sex, age, val))
+            size = sum(len(val) for _, _, _, val in parts)
+            yield {'location': np.repeat([p[0] for p in parts], [len(p[3]) for p in parts]).astype(object),
+                   'year': np.full(size, year),
+                   'sex': np.repeat([p[1] for p in parts], [len(p[3]) for p in parts]).astype(object),
+                   'age': np.concatenate([p[2] for p in parts]) if parts else np.array([], dtype=object),
+                   'val': np.concatenate([p[3] for p in parts]) if parts else np.array([])}
+    return ['location', 'year', 'sex', 'age', 'val'], chunks()
+
+
+def death_rate_rollups(snapshot, args):
+    """Simple and population-weighted mean death rates of each continent and the world (see RegionIndex)."""
+    _check_parameters(args, ('metric', 'years', 'regions'))
+    region_index = snapshot.region_index
+    metrics = _choose(args, 'metric', RATE_COLUMNS)
+    years = set(_years(args, region_index.years))
+    regions = _choose(args, 'regions', region_index.regions)
+    keep = np.array([year in years for year in region_index.years], dtype=bool)
+
+    def chunks():
+        for region in regions:
+            for col in metrics:
+                rollup = region_index.rollup(region, col)
+                size = int(keep.sum())
+                yield {'region': np.full(size, region, dtype=object),
+                       'metric': np.full(size, col, dtype=object),
+                       'year': np.asarray(rollup['years'])[keep],
+                       'mean': rollup['mean'][keep],
+                       'weighted_mean': rollup['weighted'][keep]}
+    return ['region', 'metric', 'year', 'mean', 'weighted_mean'], chunks()
+
+
+def facts(snapshot, args):
+    """Rows of the fact table (see data.FACT_SOURCES), one metric and year at a time."""
+    _check_parameters(args, ('metric', 'years', 'code', 'dimension'))
+    table = snapshot.facts
+    metrics = _choose(args, 'metric', table.metrics)
+    years = set(_years(args, sorted({year for metric in metrics for year in table.years(metric)})))
+    codes = _choose(args, 'code', table.codes) if 'code' in args else None
+    dimensions = None
+    if 'dimension' in args:
+        dimensions = set(_choose(args, 'dimension', sorted({d for metric in metrics for d in table.dimensions(metric)})))
+
+    def chunks():
+        for metric in metrics:
+            for year in table.years(metric):
+                if year not in years:
+                    continue
+                if codes is None:
+                    rows = table.query(metric, year=year)
+                else:
+                    parts = [table.query(metric, year=year, code=code) for code in codes]
+                    rows = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+                if dimensions is not None:
+                    keep = _isin(rows['dimension'], dimensions)
+                    rows = {name: values[keep] for name, values in rows.items()}
+                rows['metric'] = np.full(len(rows['value']), metric, dtype=object)
+                yield rows
+    return ['entity', 'code', 'year', 'metric', 'dimension', 'value'], chunks()
+
+
+EXPORTS = {
+    'death_rates': death_rates,
+    'prevalence': prevalence,
+    'death_rate_rollups': death_rate_rollups,
+    'facts': facts,
+}
+
+
+## writers: format -> (mimetype, function(columns, chunks) yielding the body in pieces)
+
+def _csv_value(value):
+    # NaN is an empty cell
+    return '' if isinstance(value, float) and value != value else value
+
+
+def write_csv(columns, chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(columns)
+    for chunk in chunks:
+        cells = [chunk[name].tolist() for name in columns]
+        writer.writerows([_csv_value(v) for v in row] for row in zip(*cells))
+        if buffer.tell():
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+class _Pieces(object):
+    # a write-only file that keeps what is written until it is taken
+    closed = False
+
+    def __init__(self):
+        self._pieces = []
+
+    def write(self, data):
+        self._pieces.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._pieces)
+        self._pieces = []
+        return data
+
+
+def write_arrow(columns, chunks):
+    pieces = _Pieces()
+    writer = None
+    for chunk in chunks:
+        batch = pyarrow.RecordBatch.from_arrays([pyarrow.array(chunk[name], from_pandas=True) for name in columns],
+                                                names=columns)
+        if writer is None:
+            writer = pyarrow.ipc.new_stream(pyarrow.PythonFile(pieces, mode='w'), batch.schema)
+        writer.write_batch(batch)
+        yield pieces.take()
+    if writer is not None:
+        writer.close()
+    yield pieces.take()
+
+
+# neither type is in Flask-Compress's list, so it streams them as they are instead of buffering to compress
+WRITERS = {
+    'csv': ('text/csv', write_csv),
+    'arrow': ('application/vnd.apache.arrow.stream', write_arrow),
+}
+
+
+def add_route(server, store, max_running, path='/export/<name>.<fmt>'):
+    """GET path streams an export of store's current snapshot; at most max_running stream at once."""
+    running = threading.BoundedSemaphore(max_running)
+
+    def export(name, fmt):
+        if name not in EXPORTS:
+            flask.abort(404)
+        if fmt not in WRITERS:
+            return flask.jsonify(error='unknown format {}, expected one of {}'.format(fmt, ', '.join(sorted(WRITERS)))), 400
+        if fmt == 'arrow' and pyarrow is None:
+            return flask.jsonify(error='arrow export needs pyarrow installed, use csv'), 406
+        try:
+            # the chunks read this snapshot to the end, even if a reload swaps in another meanwhile
+            columns, chunks = EXPORTS[name](store.snapshot, flask.request.args)
+        except ExportError as e:
+            return flask.jsonify(error=str(e)), 400
+        if not running.acquire(blocking=False):
+            response = flask.jsonify(error='too many exports running, try again shortly')
+            response.status_code = 503
+            response.headers['Retry-After'] = '5'
+            return response
+
+        mimetype, write = WRITERS[fmt]
+        response = flask.Response(write(columns, chunks), mimetype=mimetype)
+        response.headers['Content-Disposition'] = 'attachment; filename={}.{}'.format(name, fmt)
+        # also when the client goes away mid-download
+        response.call_on_close(running.release)
+        return response
+
+    server.add_url_rule(path, 'export', export)
@@ -0,0 +1,101 @@
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from dispatch import callback_key, encoded_response, gzip_bytes
+
+## In-memory LRU cache of serialized callback responses.
+## Every callback in app.py takes a small, finite set of inputs, so repeat views are
+## answered with the JSON Dash already produced instead of rebuilding plotly objects.
+## Each entry also keeps the gzipped body, so repeat requests pay no compression either.
+## build() compresses and stores a response where it is built, inside SingleFlight, so a crowd
+## of identical requests compresses it once; wrap() answers from the cache or from that build.
+
+
+class FigureCache(object):
+    """Thread-safe LRU cache of (JSON, gzipped JSON) responses, evicted by total size in bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # bumped by discard(), so responses built from data replaced meanwhile are not stored
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, generation=None):
+        nbytes = _entry_size(value)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= _entry_size(old)
+            self._entries[key] = value
+            self.size += nbytes
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= _entry_size(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            self.generation += 1
+
+    def discard(self, stale):
+        """Drop the entries whose key stale(key) is true, returning how many were dropped."""
+        with self._lock:
+            keys = [key for key in self._entries if stale(key)]
+            for key in keys:
+                self.size -= _entry_size(self._entries.pop(key))
+            self.generation += 1
+            return len(keys)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.size, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def build(self, callback_id, func):
+        """Wrapper turning func's response text into a stored (text, gzipped text) entry."""
+        @wraps(func)
+        def built(*args, **kwargs):
+            generation = self.generation
+            text = func(*args, **kwargs)
+            entry = (text, gzip_bytes(text))
+            self.put(callback_key(callback_id, args), entry, generation)
+            return entry
+        return built
+
+    def wrap(self, callback_id, func):
+        """Wrapper answering from the cache, or else from func, which returns an entry (see build)."""
+        @wraps(func)
+        def cached(*args, **kwargs):
+            entry = self.get(callback_key(callback_id, args))
+            if entry is None:
+                entry = func(*args, **kwargs)
+            return encoded_response(*entry)
+        return cached
+
+
+def _entry_size(entry):
+    # responses are ASCII-only JSON, so len() of the text is its size in bytes
+    text, gzipped = entry
+    return len(text) + len(gzipped)
@@ -0,0 +1,24 @@
+import gc
+import os
+
+## gunicorn settings, used by the Procfile (gunicorn app:server -c gunicorn.conf.py).
+## The app is imported once in the master and forked, so the workers share its data
+## copy-on-write instead of each loading the frames and indexes again.
+
+preload_app = True
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+
+def pre_fork(server, worker):
+    # keep the collector from touching, and so copying, the objects the workers inherit.
+    # gc.freeze is Python 3.7+, older interpreters just share less
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+
+def child_exit(server, worker):
+    # drop the exited worker's live-summed gauges from /metrics (see metrics.py)
+    if 'prometheus_multiproc_dir' in os.environ:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
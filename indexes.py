@@ -0,0 +1,381 @@
+import numpy as np
+import pandas as pd
+
+import columnar
+
+## Precomputed lookups for the callbacks in app.py.
+## Everything here is built once at startup so a callback only does dictionary lookups.
+
+RATE_COLUMNS = ['all_rate', 'cocaine_rate', 'amphetamine_rate', 'opioid_rate']
+
+
+def _same(a, b):
+    # element-wise equality of two arrays, with missing values equal to each other
+    if len(a) != len(b):
+        return False
+    missing = pd.isnull(a)
+    return bool((missing == pd.isnull(b)).all() and (a[~missing] == b[~missing]).all())
+
+
+class DeathRatesIndex(object):
+    """Death rates from global_df.csv partitioned by year.
+
+    Each year holds contiguous arrays of country codes, country names and the
+    four rate columns, in the same row order as the source frame. The arrays are
+    slices of year-sorted columns, which save()/load() keep in the columnar format
+    so worker processes can memory-map them instead of holding their own copies.
+    """
+
+    def __init__(self, columns):
+        years = np.asarray(columns['year'])
+        self.years = [int(y) for y in np.unique(years)]
+        self.maxima = {col: float(np.nanmax(columns[col])) for col in RATE_COLUMNS}
+        self._by_year = {}
+        for year in self.years:
+            start, end = np.searchsorted(years, [year, year + 1])
+            self._by_year[year] = {
+                'code': columns['code'][start:end],
+                'country': columns['country'][start:end],
+                'rates': {col: columns[col][start:end] for col in RATE_COLUMNS}
+            }
+        # a year missing from the data, asked for by a page loaded before a reload, has no rows
+        self._missing = {'code': columns['code'][:0], 'country': columns['country'][:0],
+                         'rates': {col: columns[col][:0] for col in RATE_COLUMNS}}
+        # the source has one row per country per year, so every year normally lists the same countries
+        first = self._by_year[self.years[0]]['country'].tolist()
+        self.shared_locations = all(self._by_year[y]['country'].tolist() == first for y in self.years)
+        self._columns = columns
+
+    @classmethod
+    def from_frame(cls, df):
+        ordered = df.sort_values('year', kind='mergesort')
+        columns = {'year': ordered['year'].to_numpy(),
+                   'code': ordered['code'].to_numpy(dtype=object),
+                   'country': ordered['country'].to_numpy(dtype=object)}
+        for col in RATE_COLUMNS:
+            columns[col] = np.ascontiguousarray(ordered[col].to_numpy(dtype=np.float64))
+        return cls(columns)
+
+    @classmethod
+    def load(cls, path):
+        return cls(columnar.read_arrays(path))
+
+    def save(self, path, source=None):
+        columnar.write_arrays(self._columns, path, source=source)
+
+    def year(self, year):
+        return self._by_year.get(int(year), self._missing)
+
+    def rates(self, year, col):
+        return self.year(year)['rates'][col]
+
+    def changed_years(self, other):
+        """Years whose rows differ from other's, or None when the change affects every year."""
+        if self.maxima != other.maxima or self.shared_locations != other.shared_locations:
+            # zmax, and the locations sent with the page, are the same for every year
+            return None
+        changed = set(self.years) ^ set(other.years)
+        for year in set(self.years) & set(other.years):
+            mine, theirs = self._by_year[year], other._by_year[year]
+            if not (_same(mine['code'], theirs['code']) and _same(mine['country'], theirs['country'])
+                    and all(_same(mine['rates'][col], theirs['rates'][col]) for col in RATE_COLUMNS)):
+                changed.add(year)
+        return changed
+
+
+class PrevalenceIndex(object):
+    """Prevalence by age from my_data.csv keyed by (location, year).
+
+    Each entry holds the female and male age/value arrays, already sorted by age.
+    Like DeathRatesIndex, they are slices of sorted columns that save()/load() keep
+    memory-mappable.
+    """
+
+    def __init__(self, columns):
+        locations = columns['location']
+        years = np.asarray(columns['year'])
+        sexes = columns['sex']
+        ages = columns['age']
+        vals = columns['val']
+
+        starts = np.flatnonzero(np.concatenate([[True], (locations[1:] != locations[:-1])
+                                                | (years[1:] != years[:-1])
+                                                | (sexes[1:] != sexes[:-1])]))
+        ends = np.append(starts[1:], len(vals))
+
+        empty = {'age': ages[:0], 'val': vals[:0]}
+        # a location and year missing from the data has no bars, as filtering the frame gave
+        self._missing = {'Female': empty, 'Male': empty}
+        self._by_key = {}
+        for start, end in zip(starts, ends):
+            key = (locations[start], int(years[start]))
+            entry = self._by_key.setdefault(key, {'Female': empty, 'Male': empty})
+            entry[sexes[start]] = {'age': ages[start:end], 'val': vals[start:end]}
+
+        # locations in the order they appear in the source, as listed by the region dropdown
+        self.locations = columns['locations'].tolist()
+        self.years = sorted({year for _, year in self._by_key})
+        # every location, year and sex normally covers the same age groups
+        self.ages = np.unique(ages)
+        self.shared_ages = all(len(part['age']) == len(self.ages)
+                               for entry in self._by_key.values() for part in entry.values())
+        self._columns = columns
+
+    @classmethod
+    def from_frame(cls, df):
+        # one sort, then slice each (location, year, sex) run out of the sorted columns
+        ordered = df.sort_values(['location', 'year', 'sex', 'age'], kind='mergesort')
+        return cls({'location': ordered['location'].to_numpy(dtype=object),
+                    'year': ordered['year'].to_numpy(),
+                    'sex': ordered['sex'].to_numpy(dtype=object),
+                    'age': ordered['age'].to_numpy(dtype=object),
+                    'val': np.ascontiguousarray(ordered['val'].to_numpy(dtype=np.float64)),
+                    'locations': np.asarray(list(df['location'].unique()), dtype=object)})
+
+    @classmethod
+    def load(cls, path):
+        return cls(columnar.read_arrays(path))
+
+    def save(self, path, source=None):
+        columnar.write_arrays(self._columns, path, source=source)
+
+    def get(self, location, year):
+        return self._by_key.get((location, int(year)), self._missing)
+
+    def changed_years(self, other):
+        """Years with any location whose ages or values differ from other's, or None for every year."""
+        if self.shared_ages != other.shared_ages or not _same(self.ages, other.ages):
+            return None
+        changed = set()
+        for key in set(self._by_key) | set(other._by_key):
+            mine, theirs = self._by_key.get(key), other._by_key.get(key)
+            if mine is None or theirs is None or not all(_same(mine[sex][part], theirs[sex][part])
+                                                         for sex in ('Female', 'Male') for part in ('age', 'val')):
+                changed.add(key[1])
+        return changed
+
+
+## The extent of each scope of the death-rates map, ((west, east), (south, north)) in degrees,
+## from the scopeDefaults (lonaxisRange, lataxisRange) of the plotly.js bundled with plotly.
+## The usa scope draws its albers usa projection of the United States alone.
+
+SCOPE_EXTENTS = {
+    'europe': ((-30, 60), (30, 85)),
+    'asia': ((22, 160), (-15, 55)),
+    'africa': ((-30, 60), (-40, 40)),
+    'north america': ((-180, -45), (5, 85)),
+    'south america': ((-100, -30), (-60, 15)),
+}
+SCOPE_COUNTRIES = {'usa': {'USA'}}
+# the scopes of the map's dropdown; world shows every country
+MAP_SCOPES = ['world'] + sorted(set(SCOPE_EXTENTS) | set(SCOPE_COUNTRIES))
+# degrees around an extent still in view: the map fills the graph, whose aspect seldom matches
+# the extent's, so a country just outside the ranges is often drawn at the edge
+SCOPE_MARGIN = 1.5
+
+
+def _overlaps(west, south, east, north, extent):
+    (lon_min, lon_max), (lat_min, lat_max) = extent
+    if south > lat_max + SCOPE_MARGIN or north < lat_min - SCOPE_MARGIN:
+        return False
+    # east is past 180 for a country crossing the antimeridian, Russia's Chukotka say
+    return any(west + shift <= lon_max + SCOPE_MARGIN and east + shift >= lon_min - SCOPE_MARGIN
+               for shift in (-360, 0, 360))
+
+
+def scope_members(continents):
+    """scope -> codes of the countries the map of that scope shows.
+
+    A scope shows the countries of its continent and every country whose bounding box,
+    the west, south, east and north columns of country-continents.csv, touches its extent
+    widened by SCOPE_MARGIN.
+    """
+    members = {scope: set(codes) for scope, codes in SCOPE_COUNTRIES.items()}
+    for code, continent, west, south, east, north in zip(continents['code'], continents['continent'],
+                                                         continents['west'], continents['south'],
+                                                         continents['east'], continents['north']):
+        members.setdefault(continent.lower(), set()).add(code)
+        for scope, extent in SCOPE_EXTENTS.items():
+            if _overlaps(west, south, east, north, extent):
+                members.setdefault(scope, set()).add(code)
+    return members
+
+
+class RegionIndex(object):
+    """Continent roll-ups of the death rates, and the countries each map scope shows.
+
+    For every continent and the world, year and rate column it holds the simple mean and
+    the population-weighted mean over the member countries. Population comes from the
+    Gapminder column of prevalence-of-drug-use-disorders-males-vs-females.csv and is
+    carried forward past its last year. Scope membership comes from scope_members().
+    """
+
+    def __init__(self, death_rates_index, continents, population):
+        self.years = death_rates_index.years
+        continent_of = dict(zip(continents['code'], continents['continent']))
+        self.regions = sorted(set(continent_of.values())) + ['World']
+
+        members = scope_members(continents)
+        self.scopes = sorted(members)
+
+        # population by code and year, the last known value used for later years
+        weights = population.pivot_table(index='code', columns='year', values='population')
+        weights = weights.reindex(columns=sorted(set(weights.columns) | set(self.years))).ffill(axis=1)
+
+        self._positions = {}
+        self._mean = {col: np.full((len(self.regions), len(self.years)), np.nan) for col in RATE_COLUMNS}
+        self._weighted = {col: np.full((len(self.regions), len(self.years)), np.nan) for col in RATE_COLUMNS}
+        for j, year in enumerate(self.years):
+            rows = death_rates_index.year(year)
+            codes = pd.Index(rows['code'])
+            for scope, scope_codes in members.items():
+                self._positions[(scope, year)] = np.flatnonzero(codes.isin(scope_codes))
+            region = codes.map(continent_of).to_numpy(dtype=object)
+            population_now = weights[year].reindex(codes).to_numpy(dtype=np.float64)
+            for i, name in enumerate(self.regions):
+                members_now = pd.notnull(region) if name == 'World' else region == name
+                for col in RATE_COLUMNS:
+                    values = rows['rates'][col][members_now]
+                    w = population_now[members_now]
+                    known = np.isfinite(values)
+                    weighted = known & np.isfinite(w)
+                    if known.any():
+                        self._mean[col][i, j] = values[known].mean()
+                    if weighted.any():
+                        self._weighted[col][i, j] = np.average(values[weighted], weights=w[weighted])
+
+    def positions(self, scope, year):
+        """Positions within death_rates_index.year(year) of the countries scope shows, None for all of them."""
+        return self._positions.get((scope, int(year)))
+
+    def rollup(self, region, col):
+        """Per-year simple and population-weighted means of col over region's countries."""
+        i = self.regions.index(region)
+        return {'years': self.years, 'mean': self._mean[col][i], 'weighted': self._weighted[col][i]}
+
+
+class DrugUseIndex(object):
+    """Ready-made bar chart data from drug-use-by-age.csv for each age slider position.
+
+    Each position holds the nearest age row's usage shares sorted ascending, the matching
+    drug names, the log-scaled marker colours and the number of respondents.
+    """
+
+    def __init__(self, drug_use, usage, usage_transformed, age_dict):
+        ages = np.sort(usage.index.to_numpy(dtype=np.float64))
+        self._by_position = {}
+        for position, label in age_dict.items():
+            age = ages[np.argmin(np.abs(ages - float(label)))]
+            shares = usage_transformed.loc[age, :].sort_values()
+            self._by_position[position] = {
+                'age': float(age),
+                'drugs': shares.index.to_numpy(dtype=object),
+                'shares': np.ascontiguousarray(shares.to_numpy(dtype=np.float64)),
+                'colours': np.log(usage.loc[age, :].sort_values().to_numpy(dtype=np.float64) + 0.1),
+                'respondents': int(drug_use.iloc[position, 0])
+            }
+
+    def get(self, position):
+        return self._by_position[position]
+
+
+def _codes(categorical):
+    return categorical.codes.astype(np.int16 if len(categorical.categories) < 2 ** 15 else np.int32)
+
+
+def _labels(categories):
+    # a trailing None so that the -1 code of a missing value decodes to None
+    return np.asarray(list(categories) + [None], dtype=object)
+
+
+class FactTable(object):
+    """Every metric from the OWID/GBD CSVs in one long table, see data.FACT_SOURCES.
+
+    Rows are (entity, code, year, metric, dimension, value), with the text columns
+    stored as integer codes into sorted dictionaries and the rows sorted by
+    (metric, year, code), so a query is a few searchsorted calls over
+    memory-mapped arrays rather than a scan of a frame.
+    """
+
+    def __init__(self, columns):
+        self._metric = columns['metric']
+        self._year = columns['year']
+        self._code = columns['code']
+        self._entity = columns['entity']
+        self._dimension = columns['dimension']
+        self._value = columns['value']
+        self._labels = {name: _labels(columns[name + 's'])
+                        for name in ('metric', 'code', 'entity', 'dimension')}
+        self.metrics = columns['metrics'].tolist()
+        self.codes = columns['codes'].tolist()
+        self._metric_ids = {metric: i for i, metric in enumerate(self.metrics)}
+        self._code_ids = {code: i for i, code in enumerate(self.codes)}
+        self._dimension_ids = {dimension: i for i, dimension in enumerate(columns['dimensions'].tolist())}
+        self._columns = columns
+
+    @classmethod
+    def from_frame(cls, df):
+        parts = {name: pd.Categorical(df[name]) for name in ('metric', 'code', 'entity', 'dimension')}
+        years = df['year'].to_numpy(dtype=np.int16)
+        order = np.lexsort((parts['dimension'].codes, parts['entity'].codes, parts['code'].codes,
+                            years, parts['metric'].codes))
+        columns = {name: _codes(part)[order] for name, part in parts.items()}
+        columns.update({name + 's': np.asarray(part.categories, dtype=object) for name, part in parts.items()})
+        columns['year'] = years[order]
+        columns['value'] = df['value'].to_numpy(dtype=np.float64)[order]
+        return cls(columns)
+
+    @classmethod
+    def load(cls, path):
+        return cls(columnar.read_arrays(path))
+
+    def save(self, path, source=None):
+        columnar.write_arrays(self._columns, path, source=source)
+
+    def __len__(self):
+        return len(self._value)
+
+    def _span(self, metric, year=None):
+        metric_id = self._metric_ids[metric]
+        start, end = np.searchsorted(self._metric, [metric_id, metric_id + 1])
+        if year is not None:
+            offsets = np.searchsorted(self._year[start:end], [year, year + 1])
+            start, end = start + offsets[0], start + offsets[1]
+        return start, end
+
+    def years(self, metric):
+        start, end = self._span(metric)
+        return [int(y) for y in np.unique(self._year[start:end])]
+
+    def dimensions(self, metric):
+        start, end = self._span(metric)
+        return self._labels['dimension'][np.unique(self._dimension[start:end])].tolist()
+
+    def query(self, metric, year=None, code=None, dimension=None):
+        """Rows of metric, optionally narrowed to one year, country code and dimension.
+
+        Returns a dict of arrays keyed by column name, the text columns decoded
+        to labels. Entities without a code (regional aggregates) have code None.
+        """
+        start, end = self._span(metric, year)
+        rows = slice(start, end)
+        if code is not None:
+            code_id = self._code_ids.get(code, -2)
+            if year is not None:
+                offsets = np.searchsorted(self._code[start:end], [code_id, code_id + 1])
+                rows = slice(start + offsets[0], start + offsets[1])
+            else:
+                rows = start + np.flatnonzero(self._code[start:end] == code_id)
+        if dimension is not None:
+            if isinstance(rows, slice):
+                rows = np.arange(rows.start, rows.stop)
+            rows = rows[self._dimension[rows] == self._dimension_ids.get(dimension, -2)]
+        return {'entity': self._labels['entity'][self._entity[rows]],
+                'code': self._labels['code'][self._code[rows]],
+                'year': self._year[rows],
+                'dimension': self._labels['dimension'][self._dimension[rows]],
+                'value': self._value[rows]}
+
+    def frame(self, metric, **kwargs):
+        """query() as a DataFrame."""
+        return pd.DataFrame(self.query(metric, **kwargs), columns=['entity', 'code', 'year', 'dimension', 'value'])
@@ -0,0 +1,58 @@
+import hashlib
+import threading
+
+import flask
+
+import serialize
+from dispatch import accepts_gzip, gzip_bytes
+
+## The _dash-layout response, serialized and compressed once per version of the data rather
+## than on every page load. The layout is the same for every visitor, so it is sent with a
+## strong ETag (a hash of the body) and Cache-Control: no-cache, letting browsers and CDNs keep
+## it but check it on every page load, answered with 304 Not Modified while it is current. A
+## copy used without checking could outlive a deploy and be paired with the new callbacks of
+## _dash-dependencies, which reference components it does not have.
+
+
+class LayoutResponses(object):
+    """Serves render(snapshot) for the current snapshot of store, built once per data version."""
+
+    def __init__(self, render, store):
+        self.render = render
+        self.store = store
+        self._entry = None
+        self._lock = threading.Lock()
+
+    def current(self):
+        """(version, text, gzipped, etag) for the current data, built on first use."""
+        snapshot = self.store.snapshot
+        entry = self._entry
+        if entry is None or entry[0] != snapshot.version:
+            with self._lock:
+                entry = self._entry
+                if entry is None or entry[0] != snapshot.version:
+                    text = serialize.dumps(self.render(snapshot))
+                    etag = hashlib.sha1(text.encode('utf-8')).hexdigest()
+                    entry = self._entry = (snapshot.version, text, gzip_bytes(text), etag)
+        return entry
+
+    def serve(self):
+        _, text, gzipped, etag = self.current()
+        gzip = accepts_gzip()
+        if gzip:
+            # a strong ETag names one exact body, so the gzipped one gets its own
+            etag += '-gz'
+        if flask.request.if_none_match.contains(etag):
+            response = flask.Response(status=304)
+        else:
+            response = flask.Response(gzipped if gzip else text, mimetype='application/json')
+            if gzip:
+                response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(etag)
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = 'public, no-cache'
+        return response
+
+    def replace_route(self, app):
+        """Answer app's _dash-layout requests with serve() instead of Dash's serve_layout."""
+        app.server.view_functions[app.config.routes_pathname_prefix + '_dash-layout'] = self.serve
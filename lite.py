@@ -0,0 +1,117 @@
+"""The lite data mode, for clients on slow connections.
+
+    python lite.py      # measure the error and the size saving over every map and bar response
+
+A switch in the navbar, remembered by the browser, passes 'lite' to the map and prevalence
+callbacks. They then round their values to the finest difference the chart can show instead
+of sending the 17 digits of a float64, and in patch mode send the positions of a scope's
+countries in the codes and names the page already has rather than the strings themselves.
+"""
+import math
+import sys
+
+import numpy as np
+
+LITE = 'lite'
+
+# the values the data-mode switch takes: off, on
+MODES = [[], [LITE]]
+
+
+def is_lite(mode):
+    return bool(mode) and LITE in mode
+
+
+def decimals(step):
+    """Fewest decimal places that round a value by at most half of step."""
+    return max(0, int(math.ceil(-math.log10(step))))
+
+
+def quantize(values, step):
+    """values rounded to decimals(step) places. NaN stays NaN."""
+    return np.round(values, decimals(step))
+
+
+def _rgb(colorscale):
+    return np.array([[int(colour[i:i + 2], 16) for i in (1, 3, 5)] for colour in colorscale], dtype=np.float64)
+
+
+def colour_step(colorscale, zmin, zmax):
+    """The smallest change of z that can change the colour drawn, for evenly spaced hex stops.
+
+    plotly interpolates each RGB channel linearly between two stops and draws 8-bit colours,
+    so between them the colour changes at most once per unit of the channel that changes most.
+    """
+    levels = np.abs(np.diff(_rgb(colorscale), axis=0)).max()
+    return (zmax - zmin) / (len(colorscale) - 1) / levels
+
+
+def colour_error(values, quantized, colorscale, zmin, zmax):
+    """Largest difference, in 8-bit units of any channel, between the colours of values and quantized."""
+    rgb = _rgb(colorscale)
+    stops = np.linspace(zmin, zmax, len(colorscale))
+    known = np.isfinite(values)
+    error = 0.0
+    for channel in range(3):
+        before = np.interp(values[known], stops, rgb[:, channel])
+        after = np.interp(quantized[known], stops, rgb[:, channel])
+        error = max(error, float(np.abs(np.round(before) - np.round(after)).max(initial=0)))
+    return error
+
+
+def measure(app_module):
+    """Rounding error and response size saving of lite mode, per callback, over every input."""
+    import serialize
+    from dispatch import callback_ids, split_callback_id
+
+    ids = callback_ids(app_module.app)
+    snapshot = app_module.store.snapshot
+    colorscale = app_module.choropleth_style['colorscale']
+    zmin = app_module.choropleth_style['zmin']
+    report = {}
+
+    death_rates = report['death rates'] = {}
+    for col, zmax in sorted(snapshot.death_rates_index.maxima.items()):
+        step = colour_step(colorscale, zmin, zmax)
+        z = np.concatenate([snapshot.death_rates_index.year(year)['rates'][col] for year in snapshot.years])
+        rounded = quantize(z, step)
+        death_rates[col] = {'decimals': decimals(step), 'max_abs_error': float(np.nanmax(np.abs(z - rounded))),
+                            'max_colour_error': colour_error(z, rounded, colorscale, zmin, zmax)}
+
+    step = app_module.prevalence_step
+    x = np.concatenate([sex['val'] for location in snapshot.prevalence_index.locations
+                        for year in snapshot.prevalence_years
+                        for sex in snapshot.prevalence_index.get(location, year).values()])
+    report['prevalence'] = {'decimals': decimals(step), 'max_abs_error': float(np.nanmax(np.abs(x - quantize(x, step))))}
+
+    sizes = report['bytes'] = {}
+    for name, domain in sorted(app_module.callback_domains().items()):
+        if name not in ids or not any(args[-1] in MODES for args in domain):
+            continue
+        func = serialize.wrap(ids[name], getattr(app_module, name))
+        outputs_list = split_callback_id(ids[name])
+        total = {}
+        for args in domain:
+            mode = 'lite' if is_lite(args[-1]) else 'full'
+            total[mode] = total.get(mode, 0) + len(func(*args, outputs_list=outputs_list))
+        sizes[name] = total
+    return report
+
+
+def main():
+    import app
+    report = measure(app)
+    print('death rates map, z rounded to one colour step of the scale')
+    print('{:<18} {:>8} {:>14} {:>16}'.format('column', 'decimals', 'max |dz|', 'max colour diff'))
+    for col, m in sorted(report['death rates'].items()):
+        print('{:<18} {:>8} {:>14.6f} {:>16.0f}'.format(col, m['decimals'], m['max_abs_error'], m['max_colour_error']))
+    m = report['prevalence']
+    print('\nprevalence bars: {} decimals, max |dx| {:.2e}'.format(m['decimals'], m['max_abs_error']))
+    print('\n{:<28} {:>12} {:>12} {:>7}'.format('callback', 'full bytes', 'lite bytes', 'ratio'))
+    for name, total in sorted(report['bytes'].items()):
+        print('{:<28} {:>12} {:>12} {:>7.2f}'.format(name, total['full'], total['lite'], total['full'] / float(total['lite'])))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,364 @@
+"""Load-test the app as gunicorn serves it, with simulated users moving its controls.
+
+    python loadtest.py                                  # 8 users for 30s against 2 workers x 4 threads
+    python loadtest.py --users 32 --workers 4 --threads 8 --duration 60
+    python loadtest.py --url http://localhost:8050      # a server that is already running
+    python loadtest.py --save load.json                 # also store the report
+
+Each simulated user is a thread with its own HTTP session. It loads the page the way the
+browser does (_dash-layout, _dash-dependencies, one request per callback), then repeats
+interactions for the length of the run, pausing a random think time between them: moving a
+year slider step by step, or picking another drug, scope or region. Every interaction is
+the _dash-update-component POST the browser would send for it.
+
+Reported: throughput, error rate and latency percentiles overall and per request, and for
+each gunicorn worker its resident memory (RSS), peak RSS and proportional share (PSS) of
+the pages it shares with the other workers.
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import requests
+
+from dispatch import callback_ids, update_request_body
+
+# seconds to wait for a started server to answer
+STARTUP_TIMEOUT = 120
+# seconds between samples of the workers' memory
+MEMORY_INTERVAL = 1.0
+
+
+class Interactions(object):
+    """What a user can do to each callback's inputs, read from the app's input domains.
+
+    An input with a year is moved like a slider, one year at a time; every other input
+    that takes more than one value jumps straight to a new one.
+    """
+
+    def __init__(self, app_module):
+        ids = callback_ids(app_module.app)
+        self.bodies = {}
+        self.callbacks = []
+        for name, domain in sorted(app_module.callback_domains().items()):
+            if name not in ids or not domain:
+                continue
+            # the values each argument takes, in the order the layout offers them
+            choices = []
+            for position in range(len(domain[0])):
+                seen = {}
+                for args in domain:
+                    seen.setdefault(json.dumps(args[position], sort_keys=True), args[position])
+                choices.append(list(seen.values()))
+            _, year_position = app_module.callback_datasets.get(name, (None, None))
+            self.callbacks.append((name, ids[name], choices, year_position))
+        self._app = app_module.app
+
+    def body(self, callback_id, args):
+        return update_request_body(self._app, callback_id, list(args))
+
+    def start(self, rng):
+        """Random starting values of every callback's inputs, as the page would first request them."""
+        return {name: [rng.choice(values) for values in choices] for name, _, choices, _ in self.callbacks}
+
+    def next(self, rng, state):
+        """One interaction: (callback name, callback id, [args, ...] sent in turn). Updates state."""
+        name, callback_id, choices, year_position = rng.choice(self.callbacks)
+        args = state[name]
+        movable = [i for i, values in enumerate(choices) if len(values) > 1]
+        if not movable:
+            return name, callback_id, [list(args)]
+        position = rng.choice(movable)
+        values = choices[position]
+        current = values.index(args[position])
+        target = rng.choice([i for i in range(len(values)) if i != current])
+        if position == year_position:
+            # a slider moved with the arrow keys sends every year it passes
+            step = 1 if target > current else -1
+            path = range(current + step, target + step, step)
+        else:
+            path = [target]
+        sent = []
+        for i in path:
+            args[position] = values[i]
+            sent.append(list(args))
+        return name, callback_id, sent
+
+
+class Recorder(object):
+    """Latencies and failures of every request, by request name. Shared by the user threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, name, seconds, ok):
+        with self._lock:
+            self.latencies.setdefault(name, []).append(seconds)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+
+def timed(recorder, session, name, method, url, **kwargs):
+    start = time.perf_counter()
+    try:
+        response = session.request(method, url, timeout=30, **kwargs)
+        response.content
+        # 204 is a callback that raised PreventUpdate
+        ok = response.status_code in (200, 204)
+    except requests.RequestException:
+        ok = False
+    recorder.record(name, time.perf_counter() - start, ok)
+    return ok
+
+
+def user(base_url, interactions, recorder, deadline, think, step_pause, seed):
+    rng = random.Random(seed)
+    session = requests.Session()
+    # users do not all arrive at once
+    time.sleep(rng.uniform(0, think))
+
+    timed(recorder, session, 'layout', 'GET', base_url + '/_dash-layout')
+    timed(recorder, session, 'dependencies', 'GET', base_url + '/_dash-dependencies')
+    state = interactions.start(rng)
+    for name, callback_id, _, _ in interactions.callbacks:
+        timed(recorder, session, name, 'POST', base_url + '/_dash-update-component',
+              json=interactions.body(callback_id, state[name]))
+
+    while time.time() < deadline:
+        time.sleep(rng.expovariate(1.0 / think) if think > 0 else 0)
+        name, callback_id, sent = interactions.next(rng, state)
+        for i, args in enumerate(sent):
+            if time.time() >= deadline:
+                break
+            if i:
+                time.sleep(step_pause)
+            timed(recorder, session, name, 'POST', base_url + '/_dash-update-component',
+                  json=interactions.body(callback_id, args))
+    session.close()
+
+
+## worker memory, from /proc
+
+def _children(pid):
+    found = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as f:
+                # the command name is in parentheses and may contain spaces
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (IOError, IndexError):
+            continue
+        if int(fields[1]) == pid:
+            found.append(int(entry))
+    return sorted(found)
+
+
+def _memory_kb(pid):
+    memory = {}
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('VmRSS', 'VmHWM'):
+                    memory[key] = int(value.split()[0])
+        # smaps_rollup is Linux 4.14+
+        if os.path.exists('/proc/{}/smaps_rollup'.format(pid)):
+            with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+                for line in f:
+                    if line.startswith('Pss:'):
+                        memory['Pss'] = int(line.split()[1])
+    except IOError:
+        return None
+    return memory
+
+
+class MemorySampler(object):
+    """Samples the memory of a gunicorn master's workers every MEMORY_INTERVAL seconds."""
+
+    def __init__(self, master_pid):
+        self.master_pid = master_pid
+        self.samples = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='memory-sampler', daemon=True)
+
+    def _sample(self):
+        for pid in _children(self.master_pid):
+            memory = _memory_kb(pid)
+            if memory is not None:
+                self.samples.setdefault(pid, []).append(memory)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._sample()
+            self._stop.wait(MEMORY_INTERVAL)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    def summary(self):
+        workers = {}
+        for pid, samples in sorted(self.samples.items()):
+            last = samples[-1]
+            workers[str(pid)] = {
+                'rss_mb': last.get('VmRSS', 0) / 1024.0,
+                'peak_rss_mb': max(s.get('VmHWM', 0) for s in samples) / 1024.0,
+                'pss_mb': last['Pss'] / 1024.0 if 'Pss' in last else None
+            }
+        return workers
+
+
+## the server
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_server(workers, threads, port):
+    """Start gunicorn with gunicorn.conf.py, as the Procfile does, and wait until it answers."""
+    command = [sys.executable, '-m', 'gunicorn', 'app:server', '-c', 'gunicorn.conf.py',
+               '--bind', '127.0.0.1:{}'.format(port), '--workers', str(workers), '--threads', str(threads)]
+    process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)))
+    url = 'http://127.0.0.1:{}'.format(port)
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited with status {}'.format(process.returncode))
+        try:
+            if requests.get(url + '/_dash-layout', timeout=5).status_code == 200:
+                return process, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError('gunicorn did not answer within {}s'.format(STARTUP_TIMEOUT))
+
+
+## the report
+
+def _latency_summary(latencies, errors):
+    latencies = np.asarray(latencies) * 1000
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'max_ms': float(latencies.max())
+    }
+
+
+def run(app_module, url, users, duration, think, step_pause, seed=0):
+    interactions = Interactions(app_module)
+    recorder = Recorder()
+    start = time.time()
+    deadline = start + duration
+    threads = [threading.Thread(target=user, name='user-{}'.format(i),
+                                args=(url, interactions, recorder, deadline, think, step_pause, seed + i))
+               for i in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    requests_by_name = {name: _latency_summary(latencies, recorder.errors.get(name, 0))
+                        for name, latencies in recorder.latencies.items()}
+    every = [seconds for latencies in recorder.latencies.values() for seconds in latencies]
+    total = _latency_summary(every, sum(recorder.errors.values())) if every else None
+    return {
+        'meta': {'url': url, 'users': users, 'duration': duration, 'think': think,
+                 'step_pause': step_pause, 'figure_updates': app_module.figure_updates, 'time': start},
+        'total': total,
+        'throughput_rps': len(every) / elapsed,
+        'error_rate': total['errors'] / float(total['requests']) if total else 0.0,
+        'requests': requests_by_name
+    }
+
+
+def format_report(report):
+    lines = ['{:.1f} requests/s, error rate {:.2%}'.format(report['throughput_rps'], report['error_rate']), '']
+    header = '{:<28} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9}'
+    row = '{:<28} {:>8} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}'
+    lines.append(header.format('request', 'requests', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    rows = sorted(report['requests'].items())
+    if report['total'] is not None:
+        rows.append(('all', report['total']))
+    for name, m in rows:
+        lines.append(row.format(name, m['requests'], m['errors'], m['p50_ms'], m['p95_ms'], m['p99_ms'], m['max_ms']))
+    if report.get('workers'):
+        lines.append('')
+        lines.append('{:<10} {:>9} {:>12} {:>9}'.format('worker', 'RSS MB', 'peak RSS MB', 'PSS MB'))
+        for pid, m in sorted(report['workers'].items()):
+            pss = '{:.1f}'.format(m['pss_mb']) if m['pss_mb'] is not None else '-'
+            lines.append('{:<10} {:>9.1f} {:>12.1f} {:>9}'.format(pid, m['rss_mb'], m['peak_rss_mb'], pss))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the app with simulated users.')
+    parser.add_argument('--users', type=int, default=8, help='concurrent users')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run for')
+    parser.add_argument('--think', type=float, default=2.0,
+                        help='mean seconds a user pauses between interactions (default %(default)s)')
+    parser.add_argument('--step-pause', type=float, default=0.1,
+                        help='seconds between the years of one slider move (default %(default)s)')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers to start')
+    parser.add_argument('--threads', type=int, default=4, help='threads per gunicorn worker')
+    parser.add_argument('--url', help='test this running server instead of starting one')
+    parser.add_argument('--pid', type=int, help='gunicorn master pid of --url, to report its workers')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', metavar='FILE', help='write the report as JSON')
+    args = parser.parse_args()
+
+    # the input domains and request bodies come from the app, started with the same settings
+    import app
+    process = None
+    url, master_pid = args.url, args.pid
+    if url is None:
+        process, url = start_server(args.workers, args.threads, _free_port())
+        master_pid = process.pid
+    sampler = MemorySampler(master_pid) if master_pid else None
+    try:
+        if sampler is not None:
+            sampler.start()
+        report = run(app, url.rstrip('/'), args.users, args.duration, args.think, args.step_pause, args.seed)
+    finally:
+        if sampler is not None:
+            sampler.stop()
+        if process is not None:
+            process.terminate()
+            process.wait()
+    if sampler is not None:
+        report['workers'] = sampler.summary()
+    if process is not None:
+        report['meta'].update(workers=args.workers, threads=args.threads)
+    print(format_report(report))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 1 if report['error_rate'] > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
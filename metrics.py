@@ -0,0 +1,216 @@
+import cProfile
+import heapq
+import os
+import random
+import threading
+import time
+from functools import wraps
+
+from dash.exceptions import PreventUpdate
+from flask import Response
+from prometheus_client import REGISTRY, CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+## Prometheus metrics for the Dash callbacks, served on /metrics.
+## Callbacks are labelled by name and by the inputs listed for them in app.callback_labels
+## (drug, scope, region), never by year, so the number of series stays small. A label value
+## that is not one of the options the page offers, anything a client may post, is recorded
+## as OTHER rather than as a new series.
+
+LABELS = ('callback', 'drug', 'scope', 'region')
+OTHER = 'other'
+
+
+class CallbackMetrics(object):
+    """Latency, response size and error metrics for every wrapped callback."""
+
+    def __init__(self, callback_labels, label_values=None, cache=None, single_flight=None, registry=REGISTRY,
+                 profile_rate=0.0, profile_dir=None, profile_keep=20):
+        """label_values maps a label to a function returning the set of its known values."""
+        self.callback_labels = callback_labels
+        self.label_values = label_values or {}
+        self.latency = Histogram(
+            'dash_callback_latency_seconds', 'Time spent answering a callback request.',
+            LABELS, registry=registry,
+            buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5))
+        self.response_bytes = Histogram(
+            'dash_callback_response_bytes', 'Size of the callback response body as sent.',
+            LABELS, registry=registry,
+            buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576))
+        self.errors = Counter(
+            'dash_callback_errors_total', 'Callback requests that raised an exception.',
+            LABELS + ('exception',), registry=registry)
+        self.shared_stats = None
+        if multiprocess_mode():
+            # a scrape reads one worker's registry, so each worker keeps its counts in gauges
+            # summed over the live workers instead
+            self.shared_stats = _SharedStats(cache, single_flight, registry)
+        else:
+            if cache is not None:
+                registry.register(_CacheCollector(cache))
+            if single_flight is not None:
+                registry.register(_SingleFlightCollector(single_flight))
+        self.profiler = SlowestProfiles(profile_dir, profile_keep) if profile_rate and profile_dir else None
+        self.profile_rate = profile_rate
+
+    def _labels(self, name, args):
+        labels = dict.fromkeys(LABELS, '')
+        labels['callback'] = name
+        for label, position in self.callback_labels.get(name, {}).items():
+            value = str(args[position])
+            known = self.label_values.get(label)
+            labels[label] = value if known is None or value in known() else OTHER
+        return labels
+
+    def wrap(self, callback_id, func):
+        name = func.__name__
+
+        @wraps(func)
+        def instrumented(*args, **kwargs):
+            labels = self._labels(name, args)
+            start = time.perf_counter()
+            try:
+                response = func(*args, **kwargs)
+            except PreventUpdate:
+                raise
+            except Exception as e:
+                self.errors.labels(exception=type(e).__name__, **labels).inc()
+                raise
+            finally:
+                if self.shared_stats is not None:
+                    self.shared_stats.publish()
+            self.latency.labels(**labels).observe(time.perf_counter() - start)
+            self.response_bytes.labels(**labels).observe(len(response))
+            return response
+        return instrumented
+
+    def profile(self, callback_id, func):
+        """Wrapper running a sample of calls under cProfile.
+
+        Installed innermost, around the Dash callback itself, since cProfile only sees
+        the thread it runs in and the callback may be built on the SingleFlight pool.
+        """
+        name = func.__name__
+        if self.profiler is None:
+            return func
+
+        @wraps(func)
+        def profiled(*args, **kwargs):
+            if random.random() >= self.profile_rate:
+                return func(*args, **kwargs)
+            profiler = cProfile.Profile()
+            start = time.perf_counter()
+            response = profiler.runcall(func, *args, **kwargs)
+            self.profiler.offer(time.perf_counter() - start, name, args, profiler)
+            return response
+        return profiled
+
+    def add_route(self, server, path='/metrics'):
+        server.add_url_rule(path, 'metrics', serve_metrics)
+
+
+def multiprocess_mode():
+    return 'prometheus_multiproc_dir' in os.environ
+
+
+def serve_metrics():
+    if multiprocess_mode():
+        # gunicorn workers each write their samples to files, aggregate them per scrape
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+class _CacheCollector(object):
+    """Exports a FigureCache's counters at scrape time."""
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def collect(self):
+        stats = self.cache.stats()
+        for name in ('hits', 'misses', 'evictions'):
+            yield CounterMetricFamily('dash_figure_cache_{}'.format(name),
+                                      'Figure cache {}.'.format(name), value=stats[name])
+        yield GaugeMetricFamily('dash_figure_cache_bytes', 'Bytes held by the figure cache.', value=stats['bytes'])
+        yield GaugeMetricFamily('dash_figure_cache_entries', 'Responses held by the figure cache.',
+                                value=stats['entries'])
+
+
+class _SingleFlightCollector(object):
+    """Exports a SingleFlight's coalesced request count and builds in flight at scrape time."""
+
+    def __init__(self, single_flight):
+        self.single_flight = single_flight
+
+    def collect(self):
+        stats = self.single_flight.stats()
+        yield CounterMetricFamily('dash_callback_coalesced', 'Callback requests answered by a build already running.',
+                                  value=stats['coalesced'])
+        yield GaugeMetricFamily('dash_callback_builds_in_flight', 'Distinct callback requests being built.',
+                                value=stats['in_flight'])
+
+
+class _SharedStats(object):
+    """The counters of _CacheCollector and _SingleFlightCollector as live-summed gauges, for several workers.
+
+    Updated after every callback; gunicorn.conf.py drops an exited worker's values.
+    """
+
+    def __init__(self, cache, single_flight, registry):
+        self.cache = cache
+        self.single_flight = single_flight
+        self.gauges = {}
+        if cache is not None:
+            for name, help in (('hits', 'Figure cache hits.'), ('misses', 'Figure cache misses.'),
+                               ('evictions', 'Figure cache evictions.'),
+                               ('bytes', 'Bytes held by the figure cache.'),
+                               ('entries', 'Responses held by the figure cache.')):
+                metric = 'dash_figure_cache_{}'.format(name)
+                if name not in ('bytes', 'entries'):
+                    metric += '_total'
+                self.gauges['cache', name] = Gauge(metric, help, registry=registry, multiprocess_mode='livesum')
+        if single_flight is not None:
+            self.gauges['single_flight', 'coalesced'] = Gauge(
+                'dash_callback_coalesced_total', 'Callback requests answered by a build already running.',
+                registry=registry, multiprocess_mode='livesum')
+            self.gauges['single_flight', 'in_flight'] = Gauge(
+                'dash_callback_builds_in_flight', 'Distinct callback requests being built.',
+                registry=registry, multiprocess_mode='livesum')
+
+    def publish(self):
+        stats = {'cache': self.cache.stats() if self.cache is not None else {},
+                 'single_flight': self.single_flight.stats() if self.single_flight is not None else {}}
+        for (source, name), gauge in self.gauges.items():
+            gauge.set(stats[source][name])
+
+
+class SlowestProfiles(object):
+    """Keeps cProfile dumps of the slowest sampled callback invocations in a directory."""
+
+    def __init__(self, path, keep):
+        self.path = path
+        self.keep = keep
+        self._slowest = []
+        self._lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def offer(self, elapsed, name, args, profiler):
+        with self._lock:
+            if len(self._slowest) >= self.keep and elapsed <= self._slowest[0][0]:
+                return
+            file_name = os.path.join(self.path, '{}-{:.1f}ms-{}.prof'.format(
+                name, elapsed * 1000, int(time.time() * 1000)))
+            profiler.dump_stats(file_name)
+            with open(file_name + '.txt', 'w') as f:
+                f.write('{}{!r}\n'.format(name, args))
+            heapq.heappush(self._slowest, (elapsed, file_name))
+            if len(self._slowest) > self.keep:
+                _, dropped = heapq.heappop(self._slowest)
+                for path in (dropped, dropped + '.txt'):
+                    if os.path.exists(path):
+                        os.remove(path)
@@ -0,0 +1,24 @@
+"""Clean the CSVs under data/ once and store them in the columnar format.
+
+    python preprocess.py [out_dir]
+
+app.py then memory-maps the cleaned columns at startup instead of parsing and
+cleaning the CSVs. A dataset whose CSV has changed since is read from the CSV again.
+"""
+import argparse
+
+import data
+import settings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write the cleaned datasets in columnar format.')
+    parser.add_argument('out_dir', nargs='?', default=settings.COLUMNAR_DIR)
+    args = parser.parse_args()
+
+    for name in data.preprocess(args.out_dir):
+        print('wrote {}'.format(name))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Render every callback response ahead of time.
+
+    python prerender.py build/prerendered
+
+writes one JSON response per callback input combination, a gzipped copy of each, and an
+index.json. Starting the server with PRERENDERED_DIR=build/prerendered then answers
+callbacks from those files without reading the CSVs, building any figures or compressing.
+"""
+import argparse
+import hashlib
+import json
+import os
+from functools import wraps
+
+from dash._utils import split_callback_id
+from dash.exceptions import PreventUpdate
+from plotly.utils import PlotlyJSONEncoder
+
+from dispatch import callback_ids, callback_key, encoded_response, gzip_bytes
+
+INDEX_FILE = 'index.json'
+FORMAT_VERSION = 2
+
+
+class PrerenderedResponses(object):
+    """Callback responses read back from a directory written by build()."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE), 'rb') as f:
+            raw = f.read()
+        index = json.loads(raw.decode('utf-8'))
+        # identifies the rendered data, like a Snapshot version
+        self.version = hashlib.sha1(raw).hexdigest()[:12]
+        if index['version'] != FORMAT_VERSION:
+            raise ValueError('{} was written by an incompatible prerender.py'.format(path))
+        self.meta = index['meta']
+        self.files = index['responses']
+
+    def get(self, key):
+        """The (JSON, gzipped JSON) response stored for key, or None."""
+        name = self.files.get(key)
+        if name is None:
+            return None
+        path = os.path.join(self.path, name)
+        with open(path) as f:
+            text = f.read()
+        with open(path + '.gz', 'rb') as f:
+            return text, f.read()
+
+    def wrap(self, callback_id, func):
+        @wraps(func)
+        def prerendered(*args, **kwargs):
+            entry = self.get(callback_key(callback_id, args))
+            if entry is None:
+                # nothing to compute from in this mode, leave the figure as it is
+                raise PreventUpdate
+            return encoded_response(*entry)
+        return prerendered
+
+
+def _plain(value):
+    # plotly objects and numpy arrays -> plain JSON types
+    return json.loads(json.dumps(value, cls=PlotlyJSONEncoder))
+
+
+def _file_name(key):
+    return hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json'
+
+
+def build(app_module, out_dir):
+    """Run every callback over its full input domain and write the responses to out_dir."""
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    ids = callback_ids(app_module.app)
+    files = {}
+    for name, domain in app_module.callback_domains().items():
+        if name not in ids:
+            # not registered in this figure update mode
+            continue
+        callback_id = ids[name]
+        func = app_module.app.callback_map[callback_id]['callback']
+        outputs_list = split_callback_id(callback_id)
+        for args in domain:
+            key = callback_key(callback_id, list(args))
+            files[key] = _file_name(key)
+            text = func(*args, outputs_list=outputs_list)
+            with open(os.path.join(out_dir, files[key]), 'w') as f:
+                f.write(text)
+            with open(os.path.join(out_dir, files[key] + '.gz'), 'wb') as f:
+                f.write(gzip_bytes(text))
+
+    snapshot = app_module.store.snapshot
+    meta = {
+        'years': [int(y) for y in snapshot.years],
+        'prevalence_years': [int(y) for y in snapshot.prevalence_years],
+        'regions_dict': snapshot.regions_dict,
+        'age_dict': snapshot.age_dict,
+        'fig_mh': _plain(snapshot.fig_mh.to_plotly_json()),
+        'figure_updates': app_module.figure_updates,
+        'figure_bases': _plain(snapshot.figure_bases)
+    }
+    with open(os.path.join(out_dir, INDEX_FILE), 'w') as f:
+        json.dump({'version': FORMAT_VERSION, 'meta': meta, 'responses': files}, f)
+    return len(files)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pre-render every figure served by app.py.')
+    parser.add_argument('out_dir', nargs='?', default='build/prerendered')
+    args = parser.parse_args()
+
+    if os.environ.pop('PRERENDERED_DIR', None):
+        print('ignoring PRERENDERED_DIR, rendering from the CSVs')
+    import app
+    count = build(app, args.out_dir)
+    print('wrote {} responses to {}'.format(count, args.out_dir))
+
+
+if __name__ == '__main__':
+    main()
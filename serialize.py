@@ -0,0 +1,145 @@
+import collections
+import json
+import sys
+from functools import wraps
+
+import numpy as np
+from dash import _validate
+from dash._utils import stringify_id
+from dash.dash import _NoUpdate
+from dash.exceptions import PreventUpdate
+from plotly.utils import PlotlyJSONEncoder
+
+import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+## Serialization of callback responses, replacing Dash's json.dumps with plotly's encoder,
+## which converts every array element to a Python object and then encodes the whole
+## response twice to turn NaN into null.
+## With orjson installed, as requirements.txt does, contiguous numeric arrays are written straight
+## from their buffers; otherwise the standard library encoder makes a single pass. Either way NaN becomes null.
+
+_plotly_encoder = PlotlyJSONEncoder()
+
+
+# None or NaN inside an object array, such as hover text with a missing value
+_is_null = np.frompyfunc(lambda v: v is None or (isinstance(v, (float, np.floating)) and v != v), 1, 1)
+
+
+def _missing(values):
+    # the missing values of an array, as pd.isnull finds them, without importing pandas
+    if values.dtype.kind in 'fc':
+        return np.isnan(values)
+    if values.dtype.kind in 'mM':
+        return np.isnat(values)
+    if values.dtype == object:
+        return _is_null(values).astype(bool)
+    return np.zeros(values.shape, dtype=bool)
+
+
+def _array(values):
+    # NaN is not JSON, plotly.js reads null as a missing value
+    missing = _missing(values)
+    if missing.any():
+        values = values.astype(object)
+        values[missing] = None
+    return values.tolist()
+
+
+def _default(obj):
+    if isinstance(obj, np.ndarray):
+        return _array(obj)
+    # a pandas object means pandas is loaded already, the pre-rendered app never loads it
+    pd = sys.modules.get('pandas')
+    if pd is not None and isinstance(obj, (pd.Series, pd.Index)):
+        return _array(obj.to_numpy())
+    return _plotly_encoder.default(obj)
+
+
+def _significant(values, digits):
+    # n / 10**k for the integer n of the right number of digits, which prints as that short decimal
+    values = np.asarray(values, dtype=np.float64)
+    exponent = np.zeros(values.shape)
+    scaled = np.isfinite(values) & (values != 0)
+    exponent[scaled] = np.floor(np.log10(np.abs(values[scaled])))
+    decimals = digits - 1 - exponent
+    # powers of ten are exact up to 1e22; values further out are left as they are
+    scale = 10.0 ** np.minimum(np.abs(decimals), 22)
+    with np.errstate(over='ignore', invalid='ignore'):
+        rounded = np.where(decimals >= 0, np.round(values * scale) / scale, np.round(values / scale) * scale)
+    return np.where(np.abs(decimals) <= 22, rounded, values)
+
+
+def float32_precision(obj):
+    """obj with its float arrays rounded to 7 significant digits, about the precision of a float32.
+
+    Far finer than a colour scale or a bar can show, instead of the 17 digits of a float64
+    such as 0.04659006948745757.
+    """
+    if isinstance(obj, np.ndarray) and obj.dtype.kind == 'f':
+        return _significant(obj, 7)
+    if isinstance(obj, dict):
+        return {key: float32_precision(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [float32_precision(value) for value in obj]
+    return obj
+
+
+def dumps(obj):
+    if settings.RESPONSE_FLOAT32:
+        obj = float32_precision(obj)
+    if orjson is not None:
+        # slider marks are keyed by int
+        return orjson.dumps(obj, default=_default,
+                            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS).decode()
+    try:
+        return json.dumps(obj, default=_default, allow_nan=False, separators=(',', ':'))
+    except ValueError:
+        # a NaN outside an array, leave it to plotly's encoder
+        return json.dumps(obj, cls=PlotlyJSONEncoder)
+
+
+def wrap(callback_id, func):
+    """Wrapper for Dash's add_context around a callback, building the same response with dumps.
+
+    Installed first, so it wraps the function Dash registered itself.
+    """
+    callback = func.__wrapped__
+    multi = callback_id.startswith('..')
+
+    @wraps(func)
+    def serialized(*args, **kwargs):
+        output_spec = kwargs['outputs_list']
+        output_value = callback(*args)
+
+        if isinstance(output_value, _NoUpdate):
+            raise PreventUpdate
+
+        if not multi:
+            output_value, output_spec = [output_value], [output_spec]
+
+        _validate.validate_multi_return(output_spec, output_value, callback_id)
+
+        component_ids = collections.defaultdict(dict)
+        has_update = False
+        for val, spec in zip(output_value, output_spec):
+            if isinstance(val, _NoUpdate):
+                continue
+            for vali, speci in (zip(val, spec) if isinstance(spec, list) else [[val, spec]]):
+                if not isinstance(vali, _NoUpdate):
+                    has_update = True
+                    component_ids[stringify_id(speci['id'])][speci['property']] = vali
+
+        if not has_update:
+            raise PreventUpdate
+
+        try:
+            return dumps({'response': component_ids, 'multi': True})
+        except TypeError:
+            # let Dash run it again and report the value it cannot serialize
+            return func(*args, **kwargs)
+    return serialized
@@ -0,0 +1,60 @@
+import os
+
+## Deployment settings, read from the environment so they can be set as Heroku config vars
+
+
+def _int(name, default):
+    return int(os.environ.get(name, default))
+
+
+# total size of serialized callback responses kept in memory, per worker process
+FIGURE_CACHE_BYTES = _int('FIGURE_CACHE_BYTES', 64 * 1024 * 1024)
+
+# threads building callback responses, per worker process; identical requests arriving
+# while one is being built wait for it instead of building it again (see singleflight.py).
+# Only limits builds running at once when below GUNICORN_THREADS; waiting requests keep their thread
+CALLBACK_WORKERS = _int('CALLBACK_WORKERS', 4)
+
+# seconds a callback request waits for its build before getting a 503
+CALLBACK_TIMEOUT = _int('CALLBACK_TIMEOUT', 20)
+
+# directory written by prerender.py; when set the app answers callbacks from it and reads no CSVs
+PRERENDERED_DIR = os.environ.get('PRERENDERED_DIR')
+
+# cleaned frames written by preprocess.py, loaded instead of the CSVs when present
+COLUMNAR_DIR = os.environ.get('COLUMNAR_DIR', 'data/columnar')
+
+# downloads from /export/ streamed at once, per worker process; more get a 503 (see export.py)
+EXPORT_CONCURRENCY = _int('EXPORT_CONCURRENCY', 2)
+
+# seconds between checks of the CSVs under data/ for changes, which are then loaded without a
+# restart (0 disables the check); with RELOAD_TOKEN set, POST /admin/reload with the header
+# X-Reload-Token: <token> checks at once (see datastore.py)
+DATA_RELOAD_INTERVAL = _int('DATA_RELOAD_INTERVAL', 60)
+RELOAD_TOKEN = os.environ.get('RELOAD_TOKEN')
+
+# print the startup timing report (see startup.py) when a worker boots
+STARTUP_REPORT = os.environ.get('STARTUP_REPORT', '') not in ('', '0')
+
+# how the map and prevalence figures reach the browser:
+#   full  - every callback returns the whole figure
+#   patch - the static parts of the figures ship once with the page and callbacks only
+#           return the values and titles that change (merged by assets/figure_patch.js)
+#   preload - as patch, but the callbacks return every year at once for the selected drug or
+#             region and the year sliders pick from it in the browser (assets/figure_series.js)
+FIGURE_UPDATES = os.environ.get('FIGURE_UPDATES', 'full')
+if FIGURE_UPDATES not in ('full', 'patch', 'preload'):
+    raise ValueError('FIGURE_UPDATES must be one of full, patch, preload, not {!r}'.format(FIGURE_UPDATES))
+
+# send the float arrays in callback responses rounded to 7 significant digits (about float32
+# precision), which shortens them on the wire without any visible change (see serialize.py)
+RESPONSE_FLOAT32 = os.environ.get('RESPONSE_FLOAT32', '') not in ('', '0')
+
+# gzip level for responses compressed once and stored (cached and pre-rendered responses)
+GZIP_LEVEL = _int('GZIP_LEVEL', 9)
+
+# fraction of callback invocations run under cProfile; the slowest PROFILE_KEEP of those
+# are kept in PROFILE_DIR as .prof files (0 disables profiling)
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+PROFILE_KEEP = _int('PROFILE_KEEP', 20)
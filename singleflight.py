@@ -0,0 +1,62 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError
+from functools import wraps
+
+import flask
+
+from dispatch import callback_key
+
+## Coalescing of identical callback requests that arrive while one is already being built.
+## When many clients ask for the same figure at once (everyone dragging the same slider), one
+## request builds it and the others wait for that result. Builds run on a bounded thread pool,
+## so at most max_workers distinct renders take CPU at once per process, whatever the request
+## load. The pool does not free request threads: each waiting request still holds its gunicorn
+## thread, so with max_workers at or above GUNICORN_THREADS it bounds nothing. A request that
+## waits longer than timeout seconds gets a 503; the build carries on for those still waiting.
+## The pool starts its threads on first use, so none exist yet when gunicorn forks the workers.
+
+
+class SingleFlight(object):
+    """Runs at most one build per distinct callback request at a time, on a bounded pool."""
+
+    def __init__(self, max_workers, timeout=None):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.coalesced = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='callback')
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, func, *args, **kwargs):
+        """Future for func(*args, **kwargs), shared with any call for the same key still running."""
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            future = self._executor.submit(func, *args, **kwargs)
+            self._in_flight[key] = future
+        future.add_done_callback(lambda done: self._finish(key, done))
+        return future
+
+    def _finish(self, key, future):
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight': len(self._in_flight), 'coalesced': self.coalesced,
+                    'max_workers': self.max_workers}
+
+    def wrap(self, callback_id, func):
+        @wraps(func)
+        def coalesced(*args, **kwargs):
+            # PreventUpdate and errors are raised to every waiting request alike
+            future = self.submit(callback_key(callback_id, args), func, *args, **kwargs)
+            try:
+                return future.result(timeout=self.timeout)
+            except TimeoutError:
+                flask.abort(503, 'callback build timed out')
+        return coalesced
@@ -0,0 +1,52 @@
+"""Boot-time profile of app.py.
+
+    python startup.py [--json]
+
+imports app.py and prints how long each startup phase took. app.py marks the end
+of each phase as it goes; set STARTUP_REPORT=1 to also print the report when a
+worker boots.
+"""
+import argparse
+import json
+import sys
+import time
+from collections import OrderedDict
+
+_started = time.perf_counter()
+_last = _started
+phases = OrderedDict()
+
+
+def mark(name):
+    """Record the time since the previous mark (or since this module was imported) as phase name."""
+    global _last
+    now = time.perf_counter()
+    phases[name] = now - _last
+    _last = now
+
+
+def report():
+    return {'phases': OrderedDict((name, round(seconds, 4)) for name, seconds in phases.items()),
+            'total': round(_last - _started, 4)}
+
+
+def format_report():
+    lines = ['startup timing:']
+    for name, seconds in phases.items():
+        lines.append('  {:<12} {:8.1f} ms'.format(name, seconds * 1000))
+    lines.append('  {:<12} {:8.1f} ms'.format('total', (_last - _started) * 1000))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report how long app.py takes to boot.')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    import app  # noqa: F401 -- importing it is what is being timed
+    import startup
+    print(json.dumps(startup.report()) if args.json else startup.format_report())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+import os
+import re
+
+import pandas as pd
+import plotly
+
+import indexes
+
+## Scope membership of the death-rates map (indexes.scope_members) against the country bounds
+## in data/country-continents.csv and the scope extents of the bundled plotly.js.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# countries plotly draws in each scope's default view beyond its continent
+DRAWN = {
+    'asia': 'GRC BGR ROU MDA POL LTU KEN TZA UGA RWA BDI COD ZMB MWI MOZ MDG LBY TCD CAF SSD SLB AUS PNG RUS',
+    'africa': 'ARM AZE TKM ALB MKD BGR ESP ITA GRC TUR SAU IRN',
+    'europe': 'SAU KWT TUR KAZ MAR EGY GRL',
+    'south america': 'MEX GTM SLV HND BRB GRD PAN CRI',
+    'north america': 'GUY SUR RUS COL VEN',
+}
+
+
+def _continents():
+    return pd.read_csv(os.path.join(ROOT, 'data', 'country-continents.csv'))
+
+
+def test_bounds_cover_every_country():
+    continents = _continents()
+    codes = set(pd.read_csv(os.path.join(ROOT, 'data', 'global_df.csv'))['code'].dropna()) - {'OWID_WRL'}
+    assert set(continents['code']) == codes
+    assert (continents['west'] <= continents['east']).all()
+    assert (continents['south'] <= continents['north']).all()
+    assert continents['south'].between(-90, 90).all() and continents['north'].between(-90, 90).all()
+
+
+def test_extents_match_plotly():
+    with open(os.path.join(os.path.dirname(plotly.__file__), 'package_data', 'plotly.min.js')) as f:
+        bundle = f.read()
+    for scope, ((west, east), (south, north)) in indexes.SCOPE_EXTENTS.items():
+        key = '"{}"'.format(scope) if ' ' in scope else scope
+        found = re.search(re.escape(key) + r':\{lonaxisRange:\[([-\d.]+),([-\d.]+)\],lataxisRange:\[([-\d.]+),([-\d.]+)\]', bundle)
+        assert found, scope
+        assert [float(v) for v in found.groups()] == [west, east, south, north], scope
+
+
+# (scope, code, member?) worked out by hand from the bounds and the extents
+EXPECTED = [
+    ('europe', 'TUR', True), ('europe', 'ISL', True), ('europe', 'BRA', False), ('europe', 'AUS', False),
+    ('north america', 'GUY', True), ('africa', 'GUY', False), ('south america', 'USA', False),
+    ('africa', 'USA', False), ('asia', 'BRA', False), ('asia', 'NZL', False),
+    # Russia's box runs to 190, past the antimeridian, so Chukotka is in the map of North America
+    ('north america', 'RUS', True),
+    # Fiji (177 to 180.2) and Kiribati (169.5 to 210) lie east of Asia's 160, and Fiji south of North America
+    ('asia', 'FJI', False), ('north america', 'FJI', False), ('asia', 'KIR', False),
+    ('oceania', 'FJI', True), ('oceania', 'KIR', True),
+]
+
+
+def test_members_match_expected():
+    members = indexes.scope_members(_continents())
+    for scope, code, member in EXPECTED:
+        assert (code in members[scope]) == member, (scope, code)
+
+
+def test_overlaps_across_the_antimeridian():
+    north_america = indexes.SCOPE_EXTENTS['north america']
+    asia = indexes.SCOPE_EXTENTS['asia']
+    assert indexes._overlaps(170.0, 60.0, 190.0, 70.0, north_america)       # reaches -170
+    assert not indexes._overlaps(170.0, 60.0, 178.0, 70.0, north_america)   # stops short of 180
+    assert indexes._overlaps(-200.0, 10.0, -190.0, 20.0, asia)              # 160 to 170, wrapped
+    assert not indexes._overlaps(-175.0, 10.0, -170.0, 20.0, asia)
+    assert not indexes._overlaps(170.0, -20.0, 190.0, -10.0, north_america)  # south of 5
+
+
+def test_members_include_the_countries_plotly_draws():
+    members = indexes.scope_members(_continents())
+    for scope, codes in DRAWN.items():
+        assert set(codes.split()) <= members[scope], (scope, sorted(set(codes.split()) - members[scope]))
+    assert members['usa'] == {'USA'}